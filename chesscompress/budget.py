@@ -0,0 +1,91 @@
+import collections
+import typing
+import chess
+import chess.engine
+
+class Budget:
+    """
+    Decides how hard the engine searches each position, instead of a fixed depth and time for all of them.
+
+        - a single legal move is not searched at all
+        - forcing positions, where every legal move is a capture or a check, or there is a mate in one, get a shallow search
+        - once a game has had game_plies full searches, the rest of it gets a shallow search
+
+    The decisions only depend on the positions of the game so far, never on timing, so decoding a game sees the same
+    searches as encoding it did. The searches are limited by depth only unless limit or shallow_limit are given,
+    a time limit makes the engine's scores depend on timing too. Call new_game at the start of every game.
+
+    Usage:
+        with uci.Uci(budget=Budget(game_plies=40)) as evaluator:
+            evaluator.analyze_game(game)
+        print(evaluator.budget.report())
+    """
+    def __init__(self, depth=5, limit=None, shallow_depth=1, shallow_limit=None, game_plies=None):
+        """
+        Args:
+            depth, limit - the search for ordinary positions, limit in seconds or None for no time limit
+            shallow_depth, shallow_limit - the search for forcing positions and over-budget games
+            game_plies - full searches per game, or None for no limit
+        """
+        self.depth = depth
+        self.limit = limit
+        self.shallow_depth = shallow_depth
+        self.shallow_limit = shallow_limit
+        self.game_plies = game_plies
+
+        self.searched = 0 # full searches in the current game
+        self.stats = collections.Counter()
+
+    def new_game(self):
+        self.searched = 0
+        self.stats["games"] += 1
+
+    def search_limit(self, board) -> typing.Optional[chess.engine.Limit]:
+        """
+        Returns the limit to search board with, or None if it needn't be searched
+        """
+        legal_moves = list(board.legal_moves)
+        if len(legal_moves) <= 1:
+            self.stats["skipped"] += 1
+            return None
+
+        if self.game_plies is not None and self.searched >= self.game_plies:
+            self.stats["over_budget"] += 1
+            return chess.engine.Limit(depth=self.shallow_depth, time=self.shallow_limit)
+
+        if self.forcing(board, legal_moves):
+            self.stats["shallow"] += 1
+            return chess.engine.Limit(depth=self.shallow_depth, time=self.shallow_limit)
+
+        self.searched += 1
+        self.stats["full"] += 1
+        return chess.engine.Limit(depth=self.depth, time=self.limit)
+
+    def forcing(self, board, legal_moves) -> bool:
+        only_forcing = True
+        for each_move in legal_moves:
+            if board.gives_check(each_move):
+                board.push(each_move)
+                mate = board.is_checkmate()
+                board.pop()
+                if mate:
+                    return True
+            elif not board.is_capture(each_move):
+                only_forcing = False
+        return only_forcing
+
+    def record(self, seconds):
+        """
+        Engine time, only for the report
+        """
+        self.stats["seconds"] += seconds
+
+    def report(self) -> dict:
+        """
+        How positions were budgeted so far, along with engine throughput
+        """
+        searched = self.stats["full"] + self.stats["shallow"] + self.stats["over_budget"]
+        report = dict(self.stats)
+        report["positions"] = searched + self.stats["skipped"]
+        report["positions_per_second"] = report["positions"] / self.stats["seconds"] if self.stats["seconds"] else None
+        return report
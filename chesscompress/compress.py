@@ -1,17 +1,309 @@
-from chesscompress import learn, uci
-
 """
-NotImplemented
+Arithmetic coding of chess games using the move probabilities of an Evaluator
 """
 
+import sys
+import time
+import zlib
+import struct
+import typing
+import functools
+import chess
+import chess.pgn
+from tqdm import tqdm
+from chesscompress import learn, uci
+
+
+class ArithmeticEncoder:
+    """
+    Integer arithmetic coder (Witten, Neal & Cleary) that writes into a bytearray
+
+    Usage:
+        encoder = ArithmeticEncoder()
+        encoder.encode(cumulative, index)
+        data = encoder.finish()
+    """
+    def __init__(self, precision=32):
+        self.full = (1 << precision) - 1
+        self.half = 1 << (precision - 1)
+        self.quarter = 1 << (precision - 2)
+
+        self.low = 0
+        self.high = self.full
+        self.pending = 0
+
+        self.output = bytearray()
+        self.byte = 0
+        self.bit_count = 0
+
+    def write_bit(self, bit):
+        self.byte = (self.byte << 1) | bit
+        self.bit_count += 1
+        if self.bit_count == 8:
+            self.output.append(self.byte)
+            self.byte = 0
+            self.bit_count = 0
+
+    def emit(self, bit):
+        self.write_bit(bit)
+        for _ in range(self.pending):
+            self.write_bit(1 - bit)
+        self.pending = 0
+
+    def encode(self, cumulative, index):
+        """
+        Narrows the interval to the symbol at index
+
+        Args:
+            cumulative - cumulative frequencies, cumulative[i] is the start of symbol i and cumulative[-1] is the total
+            index - the symbol to encode
+        """
+        total = cumulative[-1]
+        assert total <= self.quarter, "frequency total too large for the coder precision"
+
+        span = self.high - self.low + 1
+        self.high = self.low + span * cumulative[index + 1] // total - 1
+        self.low = self.low + span * cumulative[index] // total
+
+        while True:
+            if self.high < self.half:
+                self.emit(0)
+            elif self.low >= self.half:
+                self.emit(1)
+                self.low -= self.half
+                self.high -= self.half
+            elif self.low >= self.quarter and self.high < self.half + self.quarter:
+                self.pending += 1
+                self.low -= self.quarter
+                self.high -= self.quarter
+            else:
+                break
+            self.low = self.low * 2
+            self.high = self.high * 2 + 1
+
+    def finish(self) -> bytes:
+        """
+        Flushes the remaining state and returns the encoded bytes
+        """
+        self.pending += 1
+        if self.low < self.quarter:
+            self.emit(0)
+        else:
+            self.emit(1)
+
+        if self.bit_count:
+            self.output.append(self.byte << (8 - self.bit_count))
+            self.byte = 0
+            self.bit_count = 0
+
+        return bytes(self.output)
+
+
+class ArithmeticDecoder:
+    """
+    Decodes the output of ArithmeticEncoder, given the same sequence of frequency tables
+    """
+    def __init__(self, data, precision=32):
+        self.full = (1 << precision) - 1
+        self.half = 1 << (precision - 1)
+        self.quarter = 1 << (precision - 2)
+
+        self.data = data
+        self.position = 0 # in bits
+
+        self.low = 0
+        self.high = self.full
+        self.value = 0
+        for _ in range(precision):
+            self.value = (self.value << 1) | self.read_bit()
+
+    def read_bit(self):
+        byte_index = self.position >> 3
+        self.position += 1
+        if byte_index >= len(self.data):
+            return 0 # past the end, the encoder implicitly padded with zeros
+        return (self.data[byte_index] >> (7 - ((self.position - 1) & 7))) & 1
+
+    def decode(self, cumulative) -> int:
+        """
+        Returns the index of the next symbol and narrows the interval to it
+        """
+        total = cumulative[-1]
+        span = self.high - self.low + 1
+        target = ((self.value - self.low + 1) * total - 1) // span
+
+        # linear scan, the tables are at most a couple hundred entries long
+        index = 0
+        while cumulative[index + 1] <= target:
+            index += 1
+
+        self.high = self.low + span * cumulative[index + 1] // total - 1
+        self.low = self.low + span * cumulative[index] // total
+
+        while True:
+            if self.high < self.half:
+                pass
+            elif self.low >= self.half:
+                self.low -= self.half
+                self.high -= self.half
+                self.value -= self.half
+            elif self.low >= self.quarter and self.high < self.half + self.quarter:
+                self.low -= self.quarter
+                self.high -= self.quarter
+                self.value -= self.quarter
+            else:
+                break
+            self.low = self.low * 2
+            self.high = self.high * 2 + 1
+            self.value = (self.value << 1) | self.read_bit()
+
+        return index
+
+
+# Decoding needs the exact scores encoding saw: search by depth only, on a single thread, and the hash table
+# is cleared for every game by new_game
+DeterministicUci = functools.partial(uci.Uci, limit=None, options={"Threads": 1})
+
+
 class Compress(learn.Learn):
-    def __init__(self, loc="/Volumes/Cabinet/games/", Evaluator=uci.Uci, cache_loc="./cache/"): 
+    """
+    Compresses the mainline of PGN games into a bitstream, one arithmetic-coded record per game.
+    Only the moves are stored, games are assumed to start from the standard starting position.
+    Each record ends with a check value of the frequency tables, so a decoder whose Evaluator predicts differently
+    raises an error instead of producing the wrong game.
+
+    Usage:
+        with open("games.bin", "wb") as f:
+            Compress(loc).compress(f, n=1000)
+    """
+    def __init__(self, loc="/Volumes/Cabinet/games/", Evaluator=DeterministicUci, cache_loc="./cache/", scale=1 << 16):
         self.loc = loc
         self.cache_loc = cache_loc
         self.Evaluator = Evaluator
+        self.scale = scale # total frequency mass given to the predicted moves
+        self.filters = None # every game is compressed, ratings or not
 
         self._recursion_limit = 25000
         sys.setrecursionlimit(self._recursion_limit)
 
-    def compress(self):
-        pass
+    def distribution(self, evaluator, board) -> typing.Tuple[list, list]:
+        """
+        Turns the predicted move probabilities into a cumulative frequency table.
+        Every legal move gets a frequency of at least 1, and the last symbol marks the end of the game.
+        Evaluators with a predict_board method are handed the board itself, so they can use its move stack.
+
+        Returns:
+            (legal_moves, cumulative)
+        """
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            probabilities = {}
+        elif hasattr(evaluator, "predict_board"):
+            probabilities = evaluator.predict_board(board)
+        else:
+            probabilities = evaluator.predict(board.fen())
+
+        cumulative = [0]
+        for each_move in legal_moves:
+            frequency = max(1, int(probabilities.get(each_move, 0) * self.scale))
+            cumulative.append(cumulative[-1] + frequency)
+        cumulative.append(cumulative[-1] + 1) # end of game
+
+        return legal_moves, cumulative
+
+    def new_game(self, evaluator):
+        """
+        Resets per-game evaluator state, such as a Uci budget, so decoding sees the distributions encoding did
+        """
+        if hasattr(evaluator, "new_game"):
+            evaluator.new_game()
+
+    def check(self, cumulative, value=0) -> int:
+        """
+        Folds a frequency table into the check value of a game
+        """
+        return zlib.crc32(struct.pack(">%dI" % len(cumulative), *cumulative), value)
+
+    def encode_game(self, evaluator, each_game) -> bytes:
+        """
+        Returns the encoded moves followed by a 2 byte check value
+        """
+        self.new_game(evaluator)
+        encoder = ArithmeticEncoder()
+        board = chess.Board()
+        check = 0
+
+        for each_move in each_game.mainline_moves():
+            legal_moves, cumulative = self.distribution(evaluator, board)
+            check = self.check(cumulative, check)
+            encoder.encode(cumulative, legal_moves.index(each_move))
+            board.push(each_move)
+
+        legal_moves, cumulative = self.distribution(evaluator, board)
+        check = self.check(cumulative, check)
+        encoder.encode(cumulative, len(legal_moves))
+        return encoder.finish() + struct.pack(">H", check & 0xffff)
+
+    def decode_game(self, evaluator, data) -> chess.pgn.Game:
+        """
+        Raises ValueError if the check value doesn't match, the evaluator predicted differently than when encoding
+        """
+        self.new_game(evaluator)
+        (stored,) = struct.unpack(">H", data[-2:])
+        decoder = ArithmeticDecoder(data[:-2])
+        game = chess.pgn.Game()
+        node = game
+        board = chess.Board()
+        check = 0
+
+        while True:
+            legal_moves, cumulative = self.distribution(evaluator, board)
+            check = self.check(cumulative, check)
+            index = decoder.decode(cumulative)
+            if index == len(legal_moves):
+                break
+            if decoder.position > 8*len(data) + 64: # out of data without an end of game, the tables went out of step
+                raise ValueError("ran past the end of the game, the evaluator's predictions differ from the encoder's")
+
+            node = node.add_variation(legal_moves[index])
+            board.push(legal_moves[index])
+
+        if check & 0xffff != stored:
+            raise ValueError("check value mismatch, the evaluator's predictions differ from the encoder's")
+        return game
+
+    def compress(self, out, n=1000) -> int:
+        """
+        Streams up to n games from the dataset into out, a binary file object.
+        Each game is written as a 4 byte length followed by its encoded moves and check value.
+        Prints the bits per move against the moves per second, to weigh an Evaluator's budget.Budget.
+
+        Returns:
+            the number of bytes written
+        """
+        written = 0
+        moves = 0
+        start = time.perf_counter()
+        with self.Evaluator() as evaluator:
+            for each_game in tqdm(self.get_game(n=n), total=n):
+                data = self.encode_game(evaluator, each_game)
+                out.write(struct.pack(">I", len(data)))
+                out.write(data)
+                written += 4 + len(data)
+                moves += len(list(each_game.mainline_moves())) + 1 # including the end of game
+
+            elapsed = time.perf_counter() - start
+            print("%.3f bits/move, %.1f moves/s" % (8*written/max(moves, 1), moves/elapsed))
+            if getattr(evaluator, "budget", None):
+                print(evaluator.budget.report())
+
+        return written
+
+    def decompress(self, f) -> typing.Iterable:
+        """
+        Iterates over the games stored in f, a binary file object written by compress
+        """
+        with self.Evaluator() as evaluator:
+            while header := f.read(4):
+                (length,) = struct.unpack(">I", header)
+                yield self.decode_game(evaluator, f.read(length))
@@ -0,0 +1,123 @@
+import os
+import sys
+import importlib
+import chess
+
+fastchess_loc = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "misc", "benchmarked_backends", "fastchess")
+
+def load_fastchess(loc=fastchess_loc):
+    """
+    Imports fastchess.py from its checkout, it isn't a package and needs fasttext installed
+    """
+    loc = os.path.abspath(loc)
+    if loc not in sys.path:
+        sys.path.insert(0, loc)
+    return importlib.import_module("fastchess")
+
+class FastChess:
+    """
+    Evaluator backed by the fastText model of fastchess. The board vector is updated with Model.apply as a game
+    is walked, one ply at a time, so predicting every move of a game costs a few vector adds per ply instead of a search.
+
+    Usage:
+        with FastChess("models/fastchess.bin") as evaluator:
+            probabilities = evaluator.predict_board(board)
+    """
+    def __init__(self, model_loc="models/fastchess.bin", fastchess_loc=fastchess_loc, legal_t=-35.68, cap_t=-16.39, chk_t=-100):
+        """
+        Args:
+            model_loc - the fastText model trained by fastchess
+            fastchess_loc - the directory holding fastchess.py
+            legal_t, cap_t, chk_t - the logit floors of get_clean_moves, for legal moves, captures and checks.
+                                    Defaults to the tuned *PolicyTreshold/100 options of fastchess's uci.py
+        """
+        self.model = load_fastchess(fastchess_loc).Model(model_loc)
+        self.thresholds = dict(legal_t=legal_t, cap_t=cap_t, chk_t=chk_t)
+
+        # The last board predict_board was called with, and its vector
+        self.board = None
+        self.plies = 0
+        self.vec = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def priors(self, board, vec) -> tuple:
+        """
+        Returns:
+            (legal_moves, move_results), the priors in the order of board.legal_moves
+        """
+        legal_moves = []
+        move_results = []
+        for prior, each_move in self.model.get_clean_moves(board, vec, **self.thresholds):
+            legal_moves.append(each_move)
+            move_results.append(prior)
+        return legal_moves, move_results
+
+    def board_vec(self, board):
+        """
+        The vector of board, from the previous one if board is a single move on from it, otherwise from scratch
+        """
+        previous = self.board
+        if previous is not None and len(board.move_stack) == self.plies + 1:
+            each_move = board.move_stack[-1]
+            if previous.is_legal(each_move):
+                vec = self.model.apply(self.vec.copy(), previous, each_move)
+                previous.push(each_move)
+                if previous == board:
+                    return vec
+
+        elif previous is not None and len(board.move_stack) == self.plies and previous == board:
+            return self.vec
+
+        return self.model.from_scratch(board)
+
+    def predict_board(self, board, huffman=False) -> dict:
+        """
+        Like predict, but walking a game with the same board (as Compress does) only applies each new move
+        """
+        self.vec = self.board_vec(board)
+        self.board = board.copy(stack=False)
+        self.plies = len(board.move_stack)
+        return self.distribution(*self.priors(board, self.vec), huffman=huffman)
+
+    def analyze(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False) -> tuple:
+        board = chess.Board(fen)
+        return self.priors(board, self.model.from_scratch(board))
+
+    def analyze_batch(self, fens) -> list:
+        return [self.analyze(fen) for fen in fens]
+
+    def analyze_game(self, each_game) -> list:
+        """
+        Analyzes the position before every mainline move of each_game, applying one move at a time
+
+        Returns:
+            list of (legal_moves, move_results), one per move
+        """
+        results = []
+        board = each_game.board()
+        vec = self.model.from_scratch(board)
+        for each_move in each_game.mainline_moves():
+            results.append(self.priors(board, vec))
+            vec = self.model.apply(vec, board, each_move)
+            board.push(each_move)
+        return results
+
+    def predict(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False) -> dict:
+        return self.distribution(*self.analyze(fen), huffman=huffman)
+
+    def predict_batch(self, fens, huffman=False) -> list:
+        return [self.predict(fen, huffman=huffman) for fen in fens]
+
+    def distribution(self, legal_moves, move_results, huffman=False) -> dict:
+        """
+        The priors are already normalized, they are only sorted from most to least likely
+        """
+        moves_sorted = sorted(zip(legal_moves, move_results), key=lambda x: x[1], reverse=True)
+        if huffman:
+            return dict([(move, pow(0.5, count+1)) for count, (move, _) in enumerate(moves_sorted)])
+        return dict([(move, float(prior)) for move, prior in moves_sorted])
@@ -0,0 +1,214 @@
+import math
+import chess
+
+# Piece values and piece-square tables of the Simplified Evaluation Function, from white's side with a8 first
+values = {chess.PAWN: 100, chess.KNIGHT: 320, chess.BISHOP: 330, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+pst = {
+    chess.PAWN: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+         50,  50,  50,  50,  50,  50,  50,  50,
+         10,  10,  20,  30,  30,  20,  10,  10,
+          5,   5,  10,  25,  25,  10,   5,   5,
+          0,   0,   0,  20,  20,   0,   0,   0,
+          5,  -5, -10,   0,   0, -10,  -5,   5,
+          5,  10,  10, -20, -20,  10,  10,   5,
+          0,   0,   0,   0,   0,   0,   0,   0],
+    chess.KNIGHT: [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20,   0,   0,   0,   0, -20, -40,
+        -30,   0,  10,  15,  15,  10,   0, -30,
+        -30,   5,  15,  20,  20,  15,   5, -30,
+        -30,   0,  15,  20,  20,  15,   0, -30,
+        -30,   5,  10,  15,  15,  10,   5, -30,
+        -40, -20,   0,   5,   5,   0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50],
+    chess.BISHOP: [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,  10,  10,   5,   0, -10,
+        -10,   5,   5,  10,  10,   5,   5, -10,
+        -10,   0,  10,  10,  10,  10,   0, -10,
+        -10,  10,  10,  10,  10,  10,  10, -10,
+        -10,   5,   0,   0,   0,   0,   5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20],
+    chess.ROOK: [
+          0,   0,   0,   0,   0,   0,   0,   0,
+          5,  10,  10,  10,  10,  10,  10,   5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+          0,   0,   0,   5,   5,   0,   0,   0],
+    chess.QUEEN: [
+        -20, -10, -10,  -5,  -5, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,   5,   5,   5,   0, -10,
+         -5,   0,   5,   5,   5,   5,   0,  -5,
+          0,   0,   5,   5,   5,   5,   0,  -5,
+        -10,   5,   5,   5,   5,   5,   0, -10,
+        -10,   0,   5,   0,   0,   0,   0, -10,
+        -20, -10, -10,  -5,  -5, -10, -10, -20],
+    chess.KING: [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+         20,  20,   0,   0,   0,   0,  20,  20,
+         20,  30,  10,   0,   0,  10,  30,  20],
+}
+
+class Heuristic:
+    """
+    Engine-free Evaluator that scores moves with cheap features instead of a search: piece-square tables,
+    captures (most valuable victim, least valuable attacker), direct checks, promotions and the previous moves.
+    Trades some compression for thousands of positions per second.
+
+    Usage:
+        with Heuristic() as evaluator:
+            probabilities = evaluator.predict(fen)
+    """
+    def __init__(self, temperature=60, check=60, recapture=80, retreat=40, castle=50):
+        """
+        Args:
+            temperature - softmax temperature, in centipawns
+            check, recapture, retreat, castle - bonuses (penalty for retreat) in centipawns
+        """
+        self.temperature = temperature
+        self.check = check
+        self.recapture = recapture
+        self.retreat = retreat # moving the piece that just moved straight back
+        self.castle = castle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def square_value(self, piece_type, color, square) -> int:
+        if color == chess.WHITE:
+            square = chess.square_mirror(square)
+        return pst[piece_type][square]
+
+    def check_squares(self, board, occupied=None) -> dict:
+        """
+        The squares each piece type of the side to move gives check from, as bitmasks, given the occupied squares
+        (by default those of board). Cheaper than gives_check, which pushes every move, but blind to discovered checks.
+        """
+        king = board.king(not board.turn)
+        if king is None:
+            return dict.fromkeys(values, 0)
+
+        if occupied is None:
+            occupied = board.occupied
+        diagonal = chess.BB_DIAG_ATTACKS[king][chess.BB_DIAG_MASKS[king] & occupied]
+        straight = chess.BB_RANK_ATTACKS[king][chess.BB_RANK_MASKS[king] & occupied] | chess.BB_FILE_ATTACKS[king][chess.BB_FILE_MASKS[king] & occupied]
+        return {
+            chess.PAWN: chess.BB_PAWN_ATTACKS[not board.turn][king],
+            chess.KNIGHT: chess.BB_KNIGHT_ATTACKS[king],
+            chess.BISHOP: diagonal,
+            chess.ROOK: straight,
+            chess.QUEEN: diagonal | straight,
+            chess.KING: 0,
+        }
+
+    def score(self, board, each_move, last_move, own_last_move, check_squares) -> float:
+        """
+        A rough centipawn score of each_move for the side to move, higher is more likely
+        """
+        piece_type = board.piece_type_at(each_move.from_square)
+        lands_as = each_move.promotion or piece_type
+        score = self.square_value(lands_as, board.turn, each_move.to_square) - self.square_value(piece_type, board.turn, each_move.from_square)
+
+        if each_move.promotion:
+            score += values[each_move.promotion] - values[chess.PAWN]
+
+        if board.is_capture(each_move):
+            victim = chess.PAWN if board.is_en_passant(each_move) else board.piece_type_at(each_move.to_square)
+            score += values[victim] - values[piece_type] // 10
+            if last_move is not None and last_move.to_square == each_move.to_square:
+                score += self.recapture
+        elif board.is_castling(each_move):
+            score += self.castle
+
+        # trading into a defended square costs the piece, roughly
+        if board.is_attacked_by(not board.turn, each_move.to_square):
+            score -= values[lands_as] // 2
+
+        if each_move.promotion: # the pawn may have been blocking its own line to the king
+            check_squares = self.check_squares(board, board.occupied & ~chess.BB_SQUARES[each_move.from_square])
+        if check_squares[lands_as] & chess.BB_SQUARES[each_move.to_square]:
+            score += self.check
+
+        if own_last_move is not None and own_last_move.to_square == each_move.from_square and own_last_move.from_square == each_move.to_square:
+            score -= self.retreat
+
+        return score
+
+    def analyze_board(self, board) -> tuple:
+        """
+        Scores every legal move of board, using its move stack for the history features
+
+        Returns:
+            (legal_moves, move_results)
+        """
+        last_move = board.move_stack[-1] if board.move_stack else None
+        own_last_move = board.move_stack[-2] if len(board.move_stack) > 1 else None
+
+        check_squares = self.check_squares(board)
+
+        legal_moves = list(board.legal_moves)
+        return legal_moves, [self.score(board, each_move, last_move, own_last_move, check_squares) for each_move in legal_moves]
+
+    def analyze(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False) -> tuple:
+        return self.analyze_board(chess.Board(fen))
+
+    def analyze_batch(self, fens) -> list:
+        return [self.analyze(fen) for fen in fens]
+
+    def analyze_game(self, each_game) -> list:
+        """
+        Analyzes the position before every mainline move of each_game, with its history
+
+        Returns:
+            list of (legal_moves, move_results), one per move
+        """
+        results = []
+        board = each_game.board()
+        for each_move in each_game.mainline_moves():
+            results.append(self.analyze_board(board))
+            board.push(each_move)
+        return results
+
+    def predict(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False) -> dict:
+        return self.predict_board(chess.Board(fen), huffman=huffman)
+
+    def predict_batch(self, fens, huffman=False) -> list:
+        return [self.predict(fen, huffman=huffman) for fen in fens]
+
+    def predict_board(self, board, huffman=False) -> dict:
+        """
+        Like predict, but takes a board so the history features can see its move stack
+        """
+        legal_moves, move_results = self.analyze_board(board)
+        return self.distribution(legal_moves, move_results, huffman=huffman)
+
+    def distribution(self, legal_moves, move_results, huffman=False) -> dict:
+        """
+        Softmax of the scores, sorted from most to least likely
+        """
+        if not legal_moves:
+            return {}
+
+        best = max(move_results)
+        weights = [math.exp((result - best) / self.temperature) for result in move_results]
+        total = sum(weights)
+        moves_sorted = sorted(zip(legal_moves, weights), key=lambda x: x[1], reverse=True)
+
+        if huffman:
+            return dict([(move, pow(0.5, count+1)) for count, (move, _) in enumerate(moves_sorted)])
+        return dict([(move, weight/total) for move, weight in moves_sorted])
@@ -1,12 +1,17 @@
 import chess
+import chess.polyglot
+import collections
+import contextlib
+import itertools
 from collections.abc import Iterable
 import numpy as np
 from tensorflow import keras
 import tensorflow as tf
+import asyncio
 import functools
-import hashlib
 import sys
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import statistics
 import pickle
 import math
@@ -15,9 +20,47 @@ import chess.pgn
 from tqdm import tqdm
 # from joblib import Memory
 import glob
-from chesscompress import uci
+import io
+import mmap
+import re
+from chesscompress import uci, store, pool
 import os
 
+_model = None # loaded once per worker process, see Learn.init_worker
+
+class ShardWriter:
+    """
+    Collects featurized games and writes them out through Learn.write_shard, shard_size rows at a time
+    """
+    def __init__(self, learner, shard_size):
+        self.learner = learner
+        self.shard_size = shard_size
+
+        self.shards = []
+        self.features = []
+        self.labels = []
+        self.rows = 0
+
+    def add(self, data):
+        game_features, game_labels = self.learner.featurize(data)
+        self.features.append(game_features)
+        self.labels.append(game_labels)
+        self.rows += len(game_labels)
+
+        if self.rows >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.shards.append(self.learner.write_shard(len(self.shards), self.features, self.labels))
+        self.features, self.labels = [], []
+        self.rows = 0
+
+    def close(self) -> list:
+        self.flush()
+        print(len(self.shards))
+        return self.shards
+
 class Learn:
     """
     Benchmarks a prediction class against the given dataset.
@@ -26,11 +69,32 @@ class Learn:
         results = Benchmark(loc)
     """
     # def __init__(self, loc="/Volumes/Cabinet/games/", Evaluator=uci.Uci): 
-    def __init__(self, loc="/Volumes/Cabinet/games/", Evaluator=uci.Uci, cache_loc="./cache/", tepid = 0.01): 
+    def __init__(self, loc="/Volumes/Cabinet/games/", Evaluator=uci.Uci, cache_loc="./cache/", tepid = 0.01, engines=None, engine_options=None, model_loc="models/dataset.h5", dataset_loc="models/dataset/", filters=None, book_loc=None, parsers=None): 
+        """
+        Args:
+            filters - criteria games must meet before their moves are parsed, see accept_game.
+                      Merged over the default of games with both ratings and a known result, which analyze_dataset needs.
+            model_loc - the Keras model used by evaluate
+            dataset_loc - the directory generate writes training shards to
+            engines - the number of engine processes used by generate, defaults to the number of cores
+            parsers - the number of processes parsing games for generate, defaults to the number of cores
+            engine_options - UCI options for every engine, e.g. {"Threads": 1, "Hash": 64}
+            book_loc - an opening book built by build_book, handed to every engine
+        """
         self.loc = loc
         self.tepidness = tepid
         self.cache_loc = cache_loc
         self.Evaluator = Evaluator
+        self.engines = engines or os.cpu_count()
+        self.parsers = parsers or os.cpu_count()
+        self.engine_options = engine_options
+        self.book_loc = book_loc
+        self.engine_pool = None
+        self.model_loc = model_loc
+        self.dataset_loc = dataset_loc
+        # games without ratings or a known result can't be analyzed, user filters only narrow that down
+        self.filters = {"min_elo": 0, "results": ("1-0", "0-1", "1/2-1/2", "*"), **(filters or {})}
+        self.store = store.Store(os.path.join(cache_loc, "games.sqlite3"))
 
         self.size = 64
 
@@ -38,21 +102,70 @@ class Learn:
         sys.setrecursionlimit(self._recursion_limit)
         # self.memory = Memory(cache_loc, verbose=3)
 
+    def __getstate__(self):
+        # Engines stay in the process that started them, Pool workers start their own
+        state = self.__dict__.copy()
+        state["engine_pool"] = None
+        return state
+
+    def evaluator_kwargs(self) -> dict:
+        """
+        The arguments every Evaluator is started with
+        """
+        kwargs = {}
+        # getattr, since Compress doesn't run Learn.__init__
+        if getattr(self, "engine_options", None):
+            kwargs["options"] = self.engine_options
+        if getattr(self, "book_loc", None):
+            kwargs["book_loc"] = self.book_loc
+        return kwargs
+
+    def start_engines(self, size):
+        return pool.EnginePool(self.Evaluator, size=size, **self.evaluator_kwargs())
+
+    @contextlib.contextmanager
+    def running_engines(self, size):
+        """
+        Runs size engines for the duration of the with block, for borrow to hand out
+        """
+        self.engine_pool = self.start_engines(size)
+        try:
+            yield self.engine_pool
+        finally:
+            self.close()
+
+    def borrow(self):
+        """
+        Borrows an evaluator from the engine pool, starting a single long-lived one for this process if there is none.
+        Outside of Pool workers, call close (or use Learn as a context manager) to stop it again.
+        """
+        if self.engine_pool is None:
+            self.engine_pool = self.start_engines(1)
+        return self.engine_pool.borrow()
+
+    def close(self):
+        if self.engine_pool is not None:
+            self.engine_pool.close()
+            self.engine_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def save_cache(self, args, output):
-        filename = self.cache_loc + hashlib.sha256(str(args).encode()).hexdigest() + ".pickle"
-        with open(filename, "wb") as c:
-            print("Cache saved!")
-            c.write(pickle.dumps(output))
+        # Game results are coarse enough to commit right away, positions are batched by the Evaluator
+        self.store.put(args, output)
+        self.store.flush()
+        print("Cache saved!")
 
     def get_cache(self, args):
-        filename = self.cache_loc + hashlib.sha256(str(args).encode()).hexdigest() + ".pickle"
-        if os.path.isfile(filename):
-            with open(filename, "rb") as f:
-                result = pickle.load(f)
-                print("Cache used!")
-                # print(result)
-                # if any(result[1][0]):
-                return result
+        if result := self.store.get(args):
+            print("Cache used!")
+            # print(result)
+            # if any(result[1][0]):
+            return result
         return False
 
     def combine_reduce(self, a, b):
@@ -88,18 +201,100 @@ class Learn:
             # pickle.dump((true_probabilities, false_probabilities), f)
 
         # return true_probabilities, false_probabilities
-    def generate(self, n=10):
+    def generate(self, n=10, shard_size=1 << 18):
         """
         Generates training data, etc.
+        Games are parsed by self.parsers processes and analyzed by self.engines threads, each borrowing an engine
+        from a shared pool, with at most 2*self.engines games in flight at once.
+        Rows are written to self.dataset_loc in .npy shards of shard_size rows, see write_shard.
+
+        Returns:
+            list of (features, labels) shard files
         """
-        with Pool(os.cpu_count()) as p:
-            data = list(tqdm(p.imap(self.analyze_dataset, self.get_game(n=n)), total=n))
+        shards = ShardWriter(self, shard_size)
 
-        print(len(data))
-        with open("models/dataset.pickle", "wb") as f:
-            pickle.dump(data, f)
+        # the parsers fork before the engines start, so they don't inherit their pipes
+        with Pool(self.parsers) as parse, self.running_engines(self.engines), ThreadPool(self.engines) as p, tqdm(total=n) as progress:
+            pending = collections.deque()
+            for each_game in self.parse_games(parse, self.get_locations(n=n), block=4*self.engines):
+                if len(pending) >= 2*self.engines:
+                    shards.add(pending.popleft().get())
+                    progress.update()
+                pending.append(p.apply_async(self.analyze_dataset, (each_game,)))
 
-        return data
+            for each_result in pending:
+                shards.add(each_result.get())
+                progress.update()
+
+        return shards.close()
+
+    def parse_games(self, parse, locations, block) -> typing.Iterable:
+        """
+        Yields the games at locations, read by the parse Pool a block of games ahead of the caller
+        """
+        locations = iter(locations)
+        pending = parse.map_async(self.read_game_at, list(itertools.islice(locations, block)))
+        while games := pending.get():
+            pending = parse.map_async(self.read_game_at, list(itertools.islice(locations, block)))
+            yield from games
+
+    def generate_async(self, n=10, shard_size=1 << 18, AsyncEvaluator=uci.AsyncUci):
+        """
+        Like generate, but drives self.engines engines from one event loop in this process,
+        with at most 2*self.engines games in flight at once
+        """
+        return asyncio.run(self._generate_async(n, shard_size, AsyncEvaluator))
+
+    async def _generate_async(self, n, shard_size, AsyncEvaluator):
+        shards = ShardWriter(self, shard_size)
+        async with AsyncEvaluator(engines=self.engines, **self.evaluator_kwargs()) as evaluator:
+            pending = set()
+            with tqdm(total=n) as progress:
+                for location in self.get_locations(n=n):
+                    if len(pending) >= 2*self.engines:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for each_task in done:
+                            shards.add(each_task.result())
+                            progress.update()
+                    pending.add(asyncio.ensure_future(self.analyze_dataset_async(evaluator, location)))
+
+                for data in await asyncio.gather(*pending):
+                    shards.add(data)
+                    progress.update()
+
+        return shards.close()
+
+    def featurize(self, data) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Turns the output of analyze_dataset into fixed width model rows
+
+        Returns:
+            (features, labels) - float32 (plies x size) rows of [avg rating, move evals..., 0 padding] and the index of the move taken
+        """
+        features = np.zeros((len(data), self.size), dtype=np.float32)
+        labels = np.zeros(len(data), dtype=np.int64)
+
+        for row, (index, (move_evals, _, avg_elo)) in enumerate(data):
+            features[row, 0] = avg_elo/3500 # roughly normalized avg rating
+            move_evals = move_evals[:self.size - 1]
+            features[row, 1:len(move_evals) + 1] = move_evals
+            labels[row] = index
+
+        # moves past the last slot can't be predicted by the model
+        keep = labels < self.size
+        return features[keep], labels[keep]
+
+    def write_shard(self, number, features, labels) -> typing.Tuple[str, str]:
+        """
+        Writes one shard of the dataset, which train.py memory-maps back with np.load(mmap_mode="r")
+        """
+        os.makedirs(self.dataset_loc, exist_ok=True)
+        features_file = os.path.join(self.dataset_loc, "features-%05d.npy" % number)
+        labels_file = os.path.join(self.dataset_loc, "labels-%05d.npy" % number)
+
+        np.save(features_file, np.concatenate(features))
+        np.save(labels_file, np.concatenate(labels))
+        return features_file, labels_file
 
     def analyze_dataset(self, each_game):
         """
@@ -110,59 +305,143 @@ class Learn:
         if precomputed := self.get_cache(each_game.headers.get('Site')):
             return precomputed
 
+        # the whole game goes to one evaluator, which can reuse its search from ply to ply
+        metadata = self.game_metadata(each_game)
+        fens, moves = self.positions(each_game)
+        with self.borrow() as evaluator:
+            analyses = evaluator.analyze_game(each_game)
+
+        data = self.game_data(metadata, fens, moves, analyses)
+        self.save_cache(each_game.headers.get('Site'), data)
+        return data
+
+    async def analyze_dataset_async(self, evaluator, location):
+        """
+        analyze_dataset for an async evaluator such as uci.AsyncUci
+        """
+        # file and sqlite reads and writes go to threads, so they don't hold up the engines
+        loop = asyncio.get_running_loop()
+        each_game = await loop.run_in_executor(None, self.read_game_at, location)
+        if precomputed := await loop.run_in_executor(None, self.get_cache, each_game.headers.get('Site')):
+            return precomputed
+
+        metadata = self.game_metadata(each_game)
+        fens, moves = self.positions(each_game)
+        analyses = await evaluator.analyze_game(each_game)
+
+        data = self.game_data(metadata, fens, moves, analyses)
+        await loop.run_in_executor(None, self.save_cache, each_game.headers.get('Site'), data)
+        return data
+
+    def game_metadata(self, each_game) -> typing.Tuple[float, float]:
+        """
+        Returns:
+            (average rating, game result from white's perspective)
+        """
+        white_elo = int(each_game.headers.get("WhiteElo"))
+        black_elo = int(each_game.headers.get("BlackElo"))
+
+        game_end = each_game.headers.get("Result")
+        if game_end == "0-1":
+            game_result = 0
+        elif game_end == "1-0":
+            game_result = 1
+        elif game_end == "1/2-1/2" or game_end == "*":
+            game_result = 0.5
+        else:
+            raise ValueError(game_end)
+
+        return (black_elo + white_elo)/2, game_result
+
+    def game_data(self, metadata, fens, moves, analyses) -> list:
+        """
+        Combines the evaluator's analysis of every position with the game's metadata, see analyze_dataset
+        """
         # true_probabilities = [] # for debugging
         # false_probabilities = [] # for debugging
 
         data = []
+        avg_elo, game_result = metadata
 
-        with self.Evaluator() as evaluator:
-            white_elo = int(each_game.headers.get("WhiteElo"))
-            black_elo = int(each_game.headers.get("BlackElo"))
-
-            game_end = each_game.headers.get("Result")
-            if game_end == "0-1":
-                game_result = 0
-            elif game_end == "1-0":
-                game_result = 1
-            elif game_end == "1/2-1/2" or game_end == "*":
-                game_result = 0.5
+        for fen, each_move, (legal_moves, move_results) in zip(fens, moves, analyses):
+            # from the perspective of the side to move after each_move, like game.board().turn
+            if fen.split(" ")[1] == "b":
+                game_mod_result = game_result
             else:
-                raise ValueError(game_end)
+                game_mod_result = game_result*(-1) + 1
+            # should assert len(legal_moves) == len(move_results)
 
+            # avg_move = sum(move_results)/len(move_results)
+            min_move = min(move_results)
+            move_centered = [x - min_move + 0.001 for x in move_results] #  shifted
 
-            legal_moves, move_results = evaluator.analyze(str(chess.STARTING_FEN))
-            for counter, game in enumerate(each_game.mainline()):
-                if game.board().turn == chess.WHITE:
-                    game_mod_result = game_result
-                elif game.board().turn == chess.BLACK:
-                    game_mod_result = game_result*(-1) + 1
-                else:
-                    raise ValueError()
-                # should assert len(legal_moves) == len(move_results)
+            total = sum([abs(x) for x in move_centered])
+            if not total:
+                total = 1
+                move_results = [1 if x == 1010101 else x/total for x in move_centered] # normalized, except for mates
 
-                # avg_move = sum(move_results)/len(move_results)
-                min_move = min(move_results)
-                move_centered = [x - min_move + 0.001 for x in move_results] #  shifted
+            index = list(legal_moves).index(each_move)
 
-                total = sum([abs(x) for x in move_centered])
-                if not total:
-                    total = 1
-                    move_results = [1 if x == 1010101 else x/total for x in move_centered] # normalized, except for mates
+            # move_results = [(result, game_end, white_elo, black_elo) for result in move_results]
+            # true_probabilities.append(move_results[index])
+            # move_results.pop(index)
+            # false_probabilities.extend(move_results)
+            data.append((index, (move_results, game_mod_result, avg_elo)))
 
-                index = list(legal_moves).index(game.move) 
+        return data
 
-                # move_results = [(result, game_end, white_elo, black_elo) for result in move_results]
-                # true_probabilities.append(move_results[index])
-                # move_results.pop(index)
-                # false_probabilities.extend(move_results)
-                data.append((index, (move_results, game_mod_result, (black_elo + white_elo)/2)))
+    def positions(self, each_game) -> typing.Tuple[list, list]:
+        """
+        Walks the mainline once with a single board
 
-                # setup for next move
-                legal_moves, move_results = evaluator.analyze(str(game.board().fen()))
+        Returns:
+            (fens, moves) - the position before every move, and the move played there
+        """
+        fens, moves = [], []
+        board = each_game.board()
+        for each_move in each_game.mainline_moves():
+            fens.append(board.fen())
+            moves.append(each_move)
+            board.push(each_move)
+        return fens, moves
+
+    def build_book(self, n=10000, plies=12, positions=10000, book_loc=None) -> str:
+        """
+        Builds an opening book of the positions that come up most often in the first plies of the dataset.
+        Each position is analyzed once and stored under the Evaluator's cache key for the limit it was searched with, for Uci(book_loc=...).
+
+        Args:
+            n - the number of games to mine
+            plies - how deep into each game to count positions
+            positions - the number of most common positions to keep
+
+        Returns:
+            the location of the book
+        """
+        book_loc = book_loc or os.path.join(self.cache_loc, "book.sqlite3")
+
+        counts = collections.Counter()
+        boards = {}
+        for each_game in tqdm(self.get_game(n=n), total=n):
+            board = each_game.board()
+            for each_move in itertools.islice(each_game.mainline_moves(), plies):
+                key = chess.polyglot.zobrist_hash(board)
+                counts[key] += 1
+                if key not in boards:
+                    boards[key] = board.copy(stack=False)
+                board.push(each_move)
+
+        common = [boards[key] for key, _ in counts.most_common(positions)]
+
+        with self.running_engines(1), self.borrow() as evaluator, store.Store(book_loc) as book:
+            for board in common:
+                evaluator.new_game() # book positions come from different games, don't let a budget run across them
+                (limit,), (key,) = evaluator.search_keys([board])
+                if key: # positions needing no search are left out, they are never looked up
+                    book.put(key, evaluator.lookup([key])[0] or evaluator.analyze_board(board, limit))
+
+        return book_loc
 
-        self.save_cache(each_game.headers.get('Site'), data)
-        return data
-    
     def evaluate(self, n=100):
         """
         Evaluates prediction function according to the dataset. Each prediction function is expected to take two inputs, the board state and the player to move.
@@ -175,50 +454,66 @@ class Learn:
         # model.summary()
         # probability_model = keras.Sequential([model, tf.keras.layers.Softmax()])
 
-        with Pool(os.cpu_count()) as p:
-            entropy = functools.reduce(self.combine_reduce, tqdm(p.imap(self.evaluate_game, self.get_game(n=n)), total=n))
+        with Pool(os.cpu_count(), initializer=self.init_worker) as p:
+            entropy = functools.reduce(self.combine_reduce, tqdm(p.imap(self.evaluate_game_at, self.get_locations(n=n)), total=n))
 
         return entropy, statistics.mean(entropy), statistics.stdev(entropy)
 
+    def init_worker(self):
+        """
+        Pool initializer, loads the model once per worker process
+        """
+        global _model
+        # _model = keras.models.load_model("models/no-flip-model.h5")
+        _model = keras.models.load_model(self.model_loc)
+        _model.add(keras.layers.Softmax()) # to normalize
+
+    def get_model(self):
+        if _model is None:
+            self.init_worker()
+        return _model
+
     def evaluate_game(self, each_game):
         if precomputed := self.get_cache(each_game.headers.get('Site') + "eval"):
             return precomputed
 
         entropy = []
-        # model = keras.models.load_model("models/no-flip-model.h5")
-        model = keras.models.load_model("models/dataset.h5")
-        model.add(keras.layers.Softmax()) # to normalize
-        
-        for each_score in self.analyze_dataset(each_game):
-            # preparing for consumption
-            index = each_score[0]
-            data = ([each_score[1][2]/3500]) # roughly normalized avg rating
-            move_evals = each_score[1][0]
+        model = self.get_model()
 
-            data.extend(move_evals)
+        # preparing for consumption, one row per ply
+        scores = self.analyze_dataset(each_game)
+        rows = []
+        for each_score in scores:
+            data = ([each_score[1][2]/3500]) # roughly normalized avg rating
+            data.extend(each_score[1][0])
 
             if len(data) < self.size:
                 data.extend([0]*(self.size-len(data)))
+            rows.append(data)
 
-            data_arr = np.array([data[:self.size]])
-            # tf.expand_dims(model, axis=-1)
+        if not rows:
+            return entropy
 
-            # prediction = list(model.predict(data_arr))[0]
-            prediction = list(model.predict(data_arr)[0])
-            if len(data) > self.size:
-                prediction.extend([0]*(len(data)-self.size))
-            # prediction = prediction / prediction.sum() # TODO: fix normalization
+        # a single forward pass for the whole game
+        predictions = model.predict(np.array([data[:self.size] for data in rows]))
 
-            prediction_filtered = [max(x, self.tepidness) if index <= len(move_evals) + 1 else 0 for index, x in enumerate(prediction)]
-            # prediction_filtered = [(x + self.tepidness*5)/6 if index <= len(move_evals) + 1 else 0 for index, x in enumerate(prediction)]
-            prediction_normalized = [x/sum(prediction_filtered) for x in prediction_filtered]
+        # (plies x slots), slots past the model's output are zero like the padding
+        width = max(self.size, max(len(data) for data in rows))
+        prediction = np.zeros((len(rows), width))
+        prediction[:, :self.size] = predictions
+        # prediction = prediction / prediction.sum() # TODO: fix normalization
 
-            # probabilities.append(prediction[game.move]) # for debugging
-            # print(prediction_normalized[index], index, prediction)
+        indices = np.array([each_score[0] for each_score in scores])
+        legal_counts = np.array([len(each_score[1][0]) for each_score in scores])
+        row_widths = np.array([len(data) for data in rows])
 
-            bitrate = -math.log(prediction_normalized[index], 2) # Shannon entropy
-            print(bitrate)
-            entropy.append(bitrate)
+        slots = np.arange(width)[np.newaxis, :]
+        mask = (slots <= legal_counts[:, np.newaxis] + 1) & (slots < row_widths[:, np.newaxis])
+        prediction_filtered = np.where(mask, np.maximum(prediction, self.tepidness), 0)
+        # prediction_filtered = np.where(..., (prediction + self.tepidness*5)/6, 0)
+        prediction_normalized = prediction_filtered / prediction_filtered.sum(axis=1, keepdims=True)
+
+        entropy = (-np.log2(prediction_normalized[np.arange(len(rows)), indices])).tolist() # Shannon entropy
 
         self.save_cache(each_game.headers.get('Site') + "eval", entropy)
         return entropy
@@ -228,29 +523,137 @@ class Learn:
         # self.memory.cache(
 
 
-    def get_game(self, n=1000) -> typing.Iterable:
+    def get_game(self, n=1000, start=0, step=1) -> typing.Iterable:
+        """
+        Iterates over each game in the PGN files up to n, the parse limit
+
+        Args:
+            start - skip the games before this position, to resume a run
+            step - only take every step-th game, to sample a dump
         """
-        Iterates over each game in the PGN file up to n, the parse limit
+        for location in self.get_locations(n=n, start=start, step=step):
+            if pgn := self.read_game_at(location):
+                yield pgn
 
-        TODO: figure out proper pythonic file reading
+    def get_locations(self, n=1000, start=0, step=1) -> typing.Iterable:
+        """
+        Iterates over (file, byte offset) pairs of the games get_game would parse, without parsing them.
+        These are cheap to send to Pool workers, which then read their own games with read_game_at.
+        Games not meeting self.filters are skipped after reading only their headers.
         """
-        # for each_file in tqdm(self.get_datasets()):
         count = 0
-        pgn = True
+        base = 0 # position of the file's first game across all files
 
         for each_file in self.get_datasets():
-            # with open(each_file) as f:
-            f = open(each_file)
-            while pgn and count <= n:
-                count += 1
+            offsets = self.index_games(each_file)
+            if not len(offsets):
+                continue
+
+            # first game in this file at or after start that lies on the step grid
+            local_start = max(start - base, 0)
+            if remainder := (base + local_start - start) % step:
+                local_start += step - remainder
+
+            with open(each_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for position in range(local_start, len(offsets), step):
+                    if count > n:
+                        return
+
+                    offset = int(offsets[position])
+                    if self.filters:
+                        end = int(offsets[position + 1]) if position + 1 < len(offsets) else len(m)
+                        if not self.accept_game(m[offset:end].decode("utf-8", errors="replace")):
+                            continue
+
+                    count += 1
+                    yield each_file, offset
+
+            base += len(offsets)
+
+    def accept_game(self, text) -> bool:
+        """
+        Checks the PGN text of one game against self.filters, reading the headers and only tokenizing moves if needed.
+
+        Filters:
+            min_elo, max_elo - band for the average rating, games without numeric ratings are rejected
+            time_controls - accepted TimeControl headers, e.g. ("300+0", "600+5")
+            results - accepted Result headers
+            min_plies, max_plies - band for the mainline length
+        """
+        headers = chess.pgn.read_headers(io.StringIO(text))
+        if headers is None:
+            return False
+
+        if (results := self.filters.get("results")) and headers.get("Result") not in results:
+            return False
+
+        if (time_controls := self.filters.get("time_controls")) and headers.get("TimeControl") not in time_controls:
+            return False
+
+        if "min_elo" in self.filters or "max_elo" in self.filters:
+            try:
+                elo = (int(headers.get("WhiteElo")) + int(headers.get("BlackElo")))/2
+            except (TypeError, ValueError):
+                return False
+            if elo < self.filters.get("min_elo", 0) or elo > self.filters.get("max_elo", math.inf):
+                return False
+
+        if "min_plies" in self.filters or "max_plies" in self.filters:
+            plies = self.count_plies(re.sub(r"^\[.*\]\s*$", " ", text, flags=re.MULTILINE))
+            if plies < self.filters.get("min_plies", 0) or plies > self.filters.get("max_plies", math.inf):
+                return False
+
+        return True
+
+    def count_plies(self, movetext) -> int:
+        """
+        Counts the mainline moves of PGN movetext by tokenizing, without making the moves on a board
+        """
+        movetext = re.sub(r"\{[^}]*\}|;[^\n]*", " ", movetext) # comments
+        while "(" in movetext:
+            stripped = re.sub(r"\([^()]*\)", " ", movetext) # variations, innermost first
+            if stripped == movetext:
+                break
+            movetext = stripped
+        movetext = re.sub(r"\d+\.+|\$\d+", " ", movetext) # move numbers and NAGs
+
+        return sum(1 for token in movetext.split() if token not in ("1-0", "0-1", "1/2-1/2", "*"))
+
+    def index_games(self, each_file) -> np.ndarray:
+        """
+        Returns the byte offset of every game in the PGN file. The index is built in one pass over
+        the raw bytes and saved beside the file, so later runs don't need to rescan it.
+        """
+        index_file = each_file + ".idx.npy"
+        if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(each_file):
+            return np.load(index_file, mmap_mode="r")
+
+        offsets = np.array([], dtype=np.int64)
+        if os.path.getsize(each_file):
+            with open(each_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                # Lichess games always open with the Event tag
+                offsets = np.fromiter((match.start() for match in re.finditer(rb"^\[Event ", m, re.MULTILINE)), dtype=np.int64)
+
+        np.save(index_file, offsets)
+        return offsets
+
+    def read_game_at(self, location) -> chess.pgn.Game:
+        """
+        Parses the game starting at a (file, byte offset) pair from get_locations
+        """
+        each_file, offset = location
+        with open(each_file, "rb") as f:
+            f.seek(offset)
+            return chess.pgn.read_game(io.TextIOWrapper(f, encoding="utf-8"))
+
+    def analyze_dataset_at(self, location):
+        return self.analyze_dataset(self.read_game_at(location))
 
-                pgn = chess.pgn.read_game(f)
-                if pgn:
-                    yield pgn
-            f.close()
+    def evaluate_game_at(self, location):
+        return self.evaluate_game(self.read_game_at(location))
 
     def get_datasets(self) -> list:
-        results = glob.glob(self.loc + "lichess_db_standard_rated_2018*.pgn")
+        results = sorted(glob.glob(self.loc + "lichess_db_standard_rated_2018*.pgn")) # stable order, so start/step positions can be resumed
         return results
 
 
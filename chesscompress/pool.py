@@ -0,0 +1,50 @@
+import os
+import queue
+import contextlib
+from chesscompress import uci
+
+class EnginePool:
+    """
+    Long-lived set of Evaluators that workers borrow from, so each game doesn't pay for a
+    fresh engine process and a cold hash table.
+
+    Usage:
+        with EnginePool(uci.Uci, size=4, options={"Threads": 1, "Hash": 64}) as engines:
+            with engines.borrow() as evaluator:
+                legal_moves, move_results = evaluator.analyze(fen)
+    """
+    def __init__(self, Evaluator=uci.Uci, size=None, **kwargs):
+        """
+        Args:
+            Evaluator - the evaluator class to start
+            size - the number of evaluators (engine processes), defaults to the number of cores
+            kwargs - passed on to every Evaluator, e.g. options={"Threads": 1, "Hash": 64}
+        """
+        self.size = size or os.cpu_count()
+        self.evaluators = [Evaluator(**kwargs) for _ in range(self.size)]
+
+        self.available = queue.Queue()
+        for each_evaluator in self.evaluators:
+            self.available.put(each_evaluator)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextlib.contextmanager
+    def borrow(self):
+        """
+        Blocks until an evaluator is free and hands it out for the duration of the with block
+        """
+        evaluator = self.available.get()
+        try:
+            yield evaluator
+        finally:
+            self.available.put(evaluator)
+
+    def close(self):
+        for each_evaluator in self.evaluators:
+            each_evaluator.__exit__(None, None, None)
+        self.evaluators = []
@@ -0,0 +1,153 @@
+import os
+import pickle
+import sqlite3
+import threading
+import typing
+
+class Store:
+    """
+    Single-file key/value store backed by sqlite, used in place of one pickle file per cached call.
+    Writes are buffered and committed in batches, reads go through a memory-mapped, WAL-mode
+    connection so every Pool worker can read the same file concurrently.
+
+    Usage:
+        with Store("cache/positions.sqlite3") as store:
+            store.put(key, value)
+            value = store.get(key)
+    """
+    def __init__(self, loc, readonly=False, batch=1000, mmap_size=1 << 30, timeout=60):
+        """
+        Args:
+            loc - the location of the sqlite file
+            readonly - open the file read-only, puts are then ignored
+            batch - the number of puts buffered before they are committed
+            mmap_size - the number of bytes of the file sqlite may memory-map
+            timeout - seconds to wait for another process holding the write lock
+        """
+        self.loc = loc
+        self.readonly = readonly
+        self.batch = batch
+        self.mmap_size = mmap_size
+        self.timeout = timeout
+
+        self.connection = None
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # Connections can't cross process boundaries, each Pool worker reconnects lazily
+        state = self.__dict__.copy()
+        state["connection"] = None
+        state["pending"] = {}
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            if self.readonly:
+                if not os.path.isfile(self.loc):
+                    return None
+                self.connection = sqlite3.connect("file:" + self.loc + "?mode=ro", uri=True, timeout=self.timeout, check_same_thread=False)
+            else:
+                if os.path.dirname(self.loc):
+                    os.makedirs(os.path.dirname(self.loc), exist_ok=True)
+                self.connection = sqlite3.connect(self.loc, timeout=self.timeout, check_same_thread=False)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)")
+                self.connection.commit()
+            self.connection.execute("PRAGMA mmap_size=" + str(int(self.mmap_size)))
+        return self.connection
+
+    def get(self, key):
+        """
+        Returns the stored value, or False if key is not present
+        """
+        key = str(key)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+
+            connection = self.connect()
+            if connection is None:
+                return False
+            row = connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return False
+        return pickle.loads(row[0])
+
+    def get_many(self, keys) -> list:
+        """
+        Looks up many keys with as few queries as possible, returning False for every missing key
+        """
+        keys = [str(key) for key in keys]
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.pending:
+                    found[key] = self.pending[key]
+            missing = list(set(keys) - found.keys())
+
+            connection = self.connect() if missing else None
+            if connection is not None:
+                for start in range(0, len(missing), 500): # below sqlite's bound parameter limit
+                    chunk = missing[start:start + 500]
+                    query = "SELECT key, value FROM cache WHERE key IN (" + ",".join("?"*len(chunk)) + ")"
+                    for key, value in connection.execute(query, chunk):
+                        found[key] = pickle.loads(value)
+
+        return [found.get(key, False) for key in keys]
+
+    def items(self) -> typing.Iterable:
+        """
+        Iterates over every committed (key, value) pair
+        """
+        connection = self.connect()
+        if connection is None:
+            return
+        for key, value in connection.execute("SELECT key, value FROM cache"):
+            yield key, pickle.loads(value)
+
+    def put(self, key, value):
+        if self.readonly:
+            return
+
+        with self.lock:
+            self.pending[str(key)] = value
+            full = len(self.pending) >= self.batch
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Commits every buffered put in a single transaction
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            rows = [(key, pickle.dumps(value)) for key, value in self.pending.items()]
+            self.pending = {}
+
+            connection = self.connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", rows)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -1,42 +1,65 @@
+import asyncio
+import copy
+import time
 import chess
-import hashlib
 # from diskcache import Cache
 # from joblib import Memory
 import chess.engine
-import pickle
+import chess.polyglot
 import os
+from chesscompress import store, budget as budgets
 
 class Uci:
     """
     Implements the UCI wrapper for consumption by benchmark.py using Stockfish
     """
-    def __init__(self, loc="/usr/local/bin/stockfish", depth = 5, limit = 0.1, cache_loc="/Volumes/Cabinet/cache/stockfish-3-cache/"):
+    def __init__(self, loc="/usr/local/bin/stockfish", depth = 5, limit = 0.1, cache_loc=None, multipv=True, options=None, book_loc=None, budget=None):
     # def __init__(self, loc="/usr/local/bin/stockfish", depth = 15, limit = 0.5):
         """
         Args:
             loc - the location of the stockfish executable
-            limit - the default limit of the engine, in seconds
+            limit - the default limit of the engine, in seconds, or None to only limit the depth
+            cache_loc - directory of the sqlite position cache, e.g. "./cache/", or None to not cache
+            multipv - score every legal move with a single MultiPV search instead of one search per move
+            options - UCI options for the engine, e.g. {"Threads": 1, "Hash": 64}
+            book_loc - an opening book built by Learn.build_book, consulted before the cache and the engine
+            budget - a budget.Budget that picks the search limits per position instead of depth and limit
+        """
+        self.setup(loc, depth, limit, cache_loc, multipv, book_loc, budget)
+
+        self.engine = chess.engine.SimpleEngine.popen_uci(self.loc)
+        if options:
+            self.engine.configure(options)
+
+
+        # memory = Memory(cache_loc, verbose=1)
+        # self.analyze = memory.cache(self.analyze, ignore=['self'])
+
+    def setup(self, loc, depth, limit, cache_loc, multipv, book_loc, budget):
+        """
+        Sets up everything but the engines, shared with AsyncUci
         """
         self.loc = loc
         self.cache_loc = cache_loc 
         # Note: for a big batch conversion, try LRU
+        self.store = store.Store(os.path.join(cache_loc, "positions.sqlite3")) if cache_loc else None
+        self.book = self.load_book(book_loc)
 
         self.limit = limit
         self.depth = depth
+        self.multipv = multipv
+        self.budget = copy.deepcopy(budget) # each evaluator (e.g. in an EnginePool) tracks its own games
+        self.game = None # the game searches belong to when they aren't given one, see new_game
         self.mate_score = 1010101 # unlikely for stockfish to produce, janky solution
         self.floor = 0.001
 
-        self.engine = chess.engine.SimpleEngine.popen_uci(self.loc)
-
-
-        # memory = Memory(cache_loc, verbose=1)
-        # self.analyze = memory.cache(self.analyze, ignore=['self'])
-
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
         self.engine.close()
+        if self.store:
+            self.store.close()
 
     # def predict(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False):
         # """
@@ -46,18 +69,71 @@ class Uci:
         # return prediction(fen=fen, huffman=huffman)
 
     def save_cache(self, args, output):
-        filename = self.cache_loc + hashlib.sha256(str(args).encode()).hexdigest() + ".pickle"
-        with open(filename, "wb") as c:
-            c.write(pickle.dumps(output))
+        if self.store:
+            self.store.put(args, output)
 
     def get_cache(self, args):
-        filename = self.cache_loc + hashlib.sha256(str(args).encode()).hexdigest() + ".pickle"
-        if os.path.isfile(filename):
-            with open(filename, "rb") as f:
-                result = pickle.load(f)
-                return result
+        if self.store:
+            return self.store.get(args)
         return False
 
+    def load_book(self, book_loc) -> dict:
+        """
+        Reads the whole opening book into memory, it is small and only ever read
+        """
+        if not book_loc:
+            return {}
+        with store.Store(book_loc, readonly=True) as book:
+            return dict(book.items())
+
+    def lookup(self, keys) -> list:
+        """
+        Looks positions up in the opening book, then in the cache
+
+        Returns:
+            the stored (legal_moves, move_results) for each key, or False, always for a None key
+        """
+        results = [self.book.get(str(key), False) if key else False for key in keys]
+        missing = [index for index, result in enumerate(results) if not result and keys[index]]
+
+        if missing and self.store:
+            for index, result in zip(missing, self.store.get_many([keys[index] for index in missing])):
+                results[index] = result
+
+        return results
+
+    def cache_key(self, board, limit=None):
+        """
+        Positions are keyed by their Zobrist hash along with the search limit used, depth and limit if not given
+        """
+        if limit is None:
+            return (chess.polyglot.zobrist_hash(board), self.depth, self.limit, self.multipv)
+        return (chess.polyglot.zobrist_hash(board), limit.depth, limit.time, self.multipv)
+
+    def search_limit(self, board):
+        """
+        The limit to search board with, or None if the engine needn't be run at all
+        """
+        if self.budget:
+            return self.budget.search_limit(board)
+        return chess.engine.Limit(depth=self.depth, time=self.limit)
+
+    def new_game(self):
+        """
+        Starts a new game: the engine's hash table is cleared before its next search and the budget restarts.
+        Compress calls this before encoding or decoding each game, so both see the same engine state.
+        """
+        self.game = object()
+        if self.budget:
+            self.budget.new_game()
+
+    def search_keys(self, boards) -> tuple:
+        """
+        Picks the limit of every board, in order, and the cache key of the limit. Boards needing no search get None for both.
+        """
+        limits = [self.search_limit(board) for board in boards]
+        keys = [self.cache_key(board, limit) if limit else None for board, limit in zip(boards, limits)]
+        return limits, keys
 
     def analyze(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False) -> list:
         """
@@ -69,25 +145,141 @@ class Uci:
         Returns:
             (legal_moves, move_results)
         """
-        # if result := self.get_cache((str(fen), huffman)):
-            # return result
+        return self.analyze_batch([fen])[0]
+
+    def analyze_batch(self, fens) -> list:
+        """
+        Analyzes many positions in one call. The cache is queried once for all of them,
+        and only the positions it misses are sent to the engine.
+
+        Returns:
+            list of (legal_moves, move_results), one per fen
+        """
+        boards = [chess.Board(fen) for fen in fens] # setup boards
+        limits, keys = self.search_keys(boards)
+        results = self.lookup(keys)
+
+        for index, board in enumerate(boards):
+            if not results[index]:
+                results[index] = self.analyze_board(board, limits[index])
+                if keys[index]:
+                    self.save_cache(keys[index], results[index])
+
+        return results
+
+    def analyze_game(self, each_game) -> list:
+        """
+        Analyzes the position before every mainline move of each_game. The engine is sent the
+        move history (position startpos moves ...) and ucinewgame only once, so it keeps its hash
+        table between consecutive plies and can see repetitions.
+
+        Returns:
+            list of (legal_moves, move_results), one per move
+        """
+        self.new_game() # a new game for the engine, but not a new one per ply
+        boards = self.game_boards(each_game)
+        limits, keys = self.search_keys(boards)
+        results = self.lookup(keys)
+
+        for index, board in enumerate(boards):
+            if not results[index]:
+                results[index] = self.analyze_board(board, limits[index])
+                if keys[index]:
+                    self.save_cache(keys[index], results[index])
+
+        return results
+
+    def game_boards(self, each_game) -> list:
+        """
+        The board before every mainline move, each carrying the moves leading up to it
+        """
+        boards = []
+        board = each_game.board()
+        for each_move in each_game.mainline_moves():
+            boards.append(board.copy())
+            board.push(each_move)
+        return boards
+
+    def analyze_board(self, board, limit, game=None) -> tuple:
+        """
+        Runs the engine on board, without consulting the cache
+
+        Args:
+            limit - from search_limit, None if the engine needn't be run
+            game - identifies the game board belongs to, the engine is only reset when it changes, by default the one of new_game
+
+        Returns:
+            (legal_moves, move_results)
+        """
+        if limit is None: # a forced move, its score doesn't change the prediction
+            return list(board.legal_moves), [0]*len(list(board.legal_moves))
 
-        board = chess.Board(fen) # setup board
+        if game is None:
+            game = self.game
+        start = time.perf_counter()
+        if self.multipv:
+            results = list(board.legal_moves), self.analyze_multipv(board, limit, game=game)
+        else:
+            results = self.analyze_moves(board, limit, game=game)
+        if self.budget:
+            self.budget.record(time.perf_counter() - start)
+        return results
 
+    def analyze_moves(self, board, limit, game=None) -> tuple:
+        """
+        Scores legal moves of board with one search each
+        """
         # Getting and iterating through legal moves
         move_results = []
         for each_move in board.legal_moves:
-            analysis_results = self.engine.analyse(board, chess.engine.Limit(depth=self.depth, time=self.limit))
+            analysis_results = self.engine.analyse(board, limit, game=game)
             if analysis_results and analysis_results.score:
                 # move_results.append(analysis_results.score.white().score(mate_score = self.mate_score))
                 move_results.append(analysis_results.score.relative.score(mate_score = self.mate_score))
 
-        # self.save_cache((str(fen), huffman), (board.legal_moves, move_results))
         # print(board.legal_moves, move_results)
-        return board.legal_moves, move_results
+        return list(board.legal_moves), move_results
+
+    def analyze_multipv(self, board, limit, game=None) -> list:
+        """
+        Scores every legal move of board with one MultiPV search
+
+        Returns:
+            move_results, in the order of board.legal_moves
+        """
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            return []
+
+        analysis_results = self.engine.analyse(board, limit, multipv=len(legal_moves), game=game)
+        return self.multipv_results(legal_moves, analysis_results)
+
+    def multipv_results(self, legal_moves, analysis_results) -> list:
+        """
+        Maps the lines of a MultiPV search back onto legal_moves
+        """
+        scores = {}
+        for each_line in analysis_results:
+            if each_line.get("pv") and each_line.get("score"):
+                scores[each_line["pv"][0]] = each_line["score"].relative.score(mate_score = self.mate_score)
+
+        # Moves the engine did not report get the worst score seen
+        worst = min(scores.values()) if scores else 0
+        return [scores.get(each_move, worst) for each_move in legal_moves]
 
     def predict(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False):
-        legal_moves, move_results = self.analyze(fen=fen, huffman=huffman)
+        return self.predict_batch([fen], huffman=huffman)[0]
+
+    def predict_batch(self, fens, huffman=False) -> list:
+        """
+        Returns the move probabilities of many positions, analyzed with a single analyze_batch call
+        """
+        return [self.distribution(legal_moves, move_results, huffman=huffman) for legal_moves, move_results in self.analyze_batch(fens)]
+
+    def distribution(self, legal_moves, move_results, huffman=False) -> dict:
+        """
+        Turns engine scores into move probabilities, sorted from most to least likely
+        """
         move_shifted = [move + self.floor - min(move_results) for move in move_results] # shift up, no negatives
         move_total = sum(move_shifted) # for normalizing
 
@@ -108,3 +300,110 @@ class Uci:
 
         # TODO: Optimize speed
 
+
+class AsyncUci(Uci):
+    """
+    Keeps several Stockfish processes busy from one asyncio event loop, using the async chess.engine protocol.
+    Shares the cache and scoring of Uci, but analyze, analyze_batch, predict and predict_batch are coroutines.
+
+    Usage:
+        async with AsyncUci(engines=8) as evaluator:
+            results = await evaluator.analyze_batch(fens)
+    """
+    def __init__(self, loc="/usr/local/bin/stockfish", depth = 5, limit = 0.1, cache_loc=None, engines=None, options=None, book_loc=None):
+        """
+        Args:
+            engines - the number of engine processes, defaults to the number of cores
+        """
+        # games run concurrently, so a per-game budget can't be tracked
+        self.setup(loc, depth, limit, cache_loc, multipv=True, book_loc=book_loc, budget=None)
+
+        self.engines = engines or os.cpu_count()
+        self.options = options
+        self.protocols = []
+        self.available = None
+
+    async def __aenter__(self):
+        self.available = asyncio.Queue()
+        for _ in range(self.engines):
+            _, protocol = await chess.engine.popen_uci(self.loc)
+            if self.options:
+                await protocol.configure(self.options)
+            self.protocols.append(protocol)
+            self.available.put_nowait(protocol)
+        return self
+
+    async def __aexit__(self, *args):
+        for protocol in self.protocols:
+            await protocol.quit()
+        self.protocols = []
+        if self.store: # the final commit goes to a thread too
+            await asyncio.get_running_loop().run_in_executor(None, self.store.close)
+
+    async def analyze(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False) -> list:
+        return (await self.analyze_batch([fen]))[0]
+
+    async def analyze_batch(self, fens) -> list:
+        """
+        Like Uci.analyze_batch, with the positions the cache misses spread over every free engine
+        """
+        boards = [chess.Board(fen) for fen in fens] # setup boards
+        keys = [self.cache_key(board) for board in boards]
+        results = await asyncio.get_running_loop().run_in_executor(None, self.lookup, keys) # sqlite reads off the event loop
+
+        missing = [index for index, result in enumerate(results) if not result]
+        for index, result in zip(missing, await asyncio.gather(*[self.analyze_board(boards[index]) for index in missing])):
+            results[index] = result
+        # a put commits to sqlite every store.batch puts, so the writes go off the event loop as well
+        await asyncio.get_running_loop().run_in_executor(None, self.save_many, [keys[index] for index in missing], [results[index] for index in missing])
+
+        return results
+
+    async def analyze_game(self, each_game) -> list:
+        """
+        Like Uci.analyze_game, holding on to one engine for the whole game
+        """
+        game_id = object()
+        boards = self.game_boards(each_game)
+        keys = [self.cache_key(board) for board in boards]
+        results = await asyncio.get_running_loop().run_in_executor(None, self.lookup, keys) # sqlite reads off the event loop
+
+        if not all(results):
+            protocol = await self.available.get()
+            try:
+                for index, board in enumerate(boards):
+                    if not results[index]:
+                        results[index] = await self.analyze_board(board, protocol=protocol, game=game_id)
+                        await asyncio.get_running_loop().run_in_executor(None, self.save_cache, keys[index], results[index])
+            finally:
+                self.available.put_nowait(protocol)
+
+        return results
+
+    def save_many(self, keys, results):
+        for key, result in zip(keys, results):
+            self.save_cache(key, result)
+
+    async def analyze_board(self, board, protocol=None, game=None) -> tuple:
+        """
+        Runs one MultiPV search, on protocol if given, otherwise on the next free engine
+        """
+        legal_moves = list(board.legal_moves)
+        if not legal_moves:
+            return legal_moves, []
+
+        if protocol is not None:
+            analysis_results = await protocol.analyse(board, chess.engine.Limit(depth=self.depth, time=self.limit), multipv=len(legal_moves), game=game)
+            return legal_moves, self.multipv_results(legal_moves, analysis_results)
+
+        protocol = await self.available.get()
+        try:
+            return await self.analyze_board(board, protocol=protocol, game=game)
+        finally:
+            self.available.put_nowait(protocol)
+
+    async def predict(self, fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", huffman=False):
+        return (await self.predict_batch([fen], huffman=huffman))[0]
+
+    async def predict_batch(self, fens, huffman=False) -> list:
+        return [self.distribution(legal_moves, move_results, huffman=huffman) for legal_moves, move_results in await self.analyze_batch(fens)]
@@ -3,7 +3,8 @@ import time
 import numpy as np
 import random
 import math
-import itertools
+import multiprocessing
+import queue
 
 import fastchess
 import mcts
@@ -14,6 +15,47 @@ STAT_INTERVAL = 300
 MIN_PV_VISITS = 30
 
 Stats = namedtuple('Stats', ['kl_div', 'rolls', 'elapsed'])
+# Dirichlet noise mixed into the root priors of helper processes, so they
+# don't all search the same tree.
+ROOT_NOISE = .25
+ROOT_ALPHA = .3
+# Seconds to wait for a final helper report before checking the helper is alive,
+# and in all before giving up on a helper that is alive but not reporting
+HELPER_TIMEOUT = .1
+HELPER_DEADLINE = 1
+
+
+def rollout(node, batch):
+    """ A rollout from `node`, or a batch of up to `batch` of them with their
+        leaves evaluated together. Returns the number of rollouts done. """
+    if batch > 1:
+        return node.rollout_batch(batch)
+    node.rollout()
+    return 1
+
+
+def search_worker(args, board, worker, stop, results, count):
+    """ Root-parallel helper: searches its own tree from `board` until `stop` is
+        set, sending the visits and values of the root children to `results`
+        every STAT_INTERVAL rollouts. The rollouts so far are kept in `count`. """
+    np.random.seed(worker)
+    node = mcts.Tree(board, args.model.from_scratch(board), args).root
+    while node.N < 2:
+        node.rollout()
+    tree = node.tree
+    children = tree.children(node.index)
+    s = slice(children.start, children.stop)
+    tree.P[s] = (1 - ROOT_NOISE) * tree.P[s] + \
+        ROOT_NOISE * np.random.dirichlet([ROOT_ALPHA] * len(children))
+
+    rolls = reported = 0
+    while not stop.is_set():
+        rolls += rollout(node, args.batch)
+        count.value = rolls
+        if rolls >= reported + STAT_INTERVAL:
+            reported = rolls
+            results.put((worker, rolls, tree.N[s].copy(), tree.Q[s].copy(), False))
+    results.put((worker, rolls, tree.N[s].copy(), tree.Q[s].copy(), True))
 
 
 class MCTS_Controller:
@@ -21,44 +63,136 @@ class MCTS_Controller:
         self.args = args
         self.node = None
         self.should_stop = False
+        # The latest (rolls, N, Q) of the root children from each helper process
+        self.helpers = {}
+        self.helper_results = None
+        # The live rollout count of each helper process
+        self.helper_counts = {}
+
+    def start_helpers(self, board):
+        """ Starts args.threads - 1 helper processes searching `board`, the
+            main process being the first thread. """
+        self.helpers = {}
+        self.helper_counts = {}
+        if self.args.threads <= 1:
+            return []
+        # Forking shares the model with the helpers instead of pickling it,
+        # so collect_helpers has to cope with a helper dying in a bad fork
+        context = multiprocessing.get_context('fork')
+        self.helper_stop = context.Event()
+        self.helper_results = context.Queue()
+        self.helper_counts = {worker: context.RawValue('q', 0) for worker in range(1, self.args.threads)}
+        processes = [context.Process(target=search_worker, daemon=True,
+                                     args=(self.args, board, worker, self.helper_stop, self.helper_results,
+                                           self.helper_counts[worker]))
+                     for worker in range(1, self.args.threads)]
+        for process in processes:
+            process.start()
+        return processes
+
+    def collect_helpers(self, processes=()):
+        """ Reads the reports of the helpers. With `processes`, stops them
+            and waits for their final reports, or for them to die. Helpers
+            still not done by HELPER_DEADLINE are terminated and dropped. """
+        if not self.helper_results:
+            return
+        if processes:
+            self.helper_stop.set()
+        pending = {worker: process for worker, process in enumerate(processes, 1)}
+        deadline = time.time() + HELPER_DEADLINE
+        while True:
+            try:
+                if pending:
+                    report = self.helper_results.get(timeout=HELPER_TIMEOUT)
+                else:
+                    report = self.helper_results.get(block=False)
+            except queue.Empty:
+                if not pending:
+                    break
+                # A helper that crashed won't send its final report
+                pending = {worker: process for worker, process in pending.items()
+                           if process.is_alive()}
+                if pending and time.time() > deadline:
+                    # Deadlocked, e.g. on a lock some thread held at the fork.
+                    # Whatever is left in the queue comes from dead helpers.
+                    for worker, process in pending.items():
+                        process.terminate()
+                        self.helpers.pop(worker, None)
+                        self.helper_counts.pop(worker, None)
+                    break
+                continue
+            worker, rolls, N, Q, done = report
+            self.helpers[worker] = (rolls, N, Q)
+            if done:
+                pending.pop(worker, None)
+        for process in processes:
+            process.join()
+        if processes:
+            self.helper_results = None
+
+    def helper_rolls(self):
+        """ Rollouts of the helpers so far, read live rather than from their reports. """
+        return sum(count.value for count in self.helper_counts.values())
+
+    def root_stats(self):
+        """ Visits and average values of the root children, merged over the
+            main tree and the helpers. """
+        children = self.node.children
+        N = np.array([n.N for n in children], dtype=np.float64)
+        W = N * np.array([n.Q for n in children])
+        for _, helper_N, helper_Q in self.helpers.values():
+            if len(helper_N) == len(N):
+                N += helper_N
+                W += helper_N * helper_Q
+        return N, W / np.maximum(N, 1)
 
     def print_stats(self, is_first, pvs):
+        root_N, root_Q = self.root_stats()
         if is_first:
-            self.old_dist = np.array([1 + n.N for n in self.node.children])
+            self.old_dist = 1 + root_N
             self.old_dist = self.old_dist / self.old_dist.sum()
             self.start_time = time.time()
             self.old_time = time.time()
+            self.old_nodes = self.node.N + self.helper_rolls()
             return 1
 
-        dist = np.array([1 + n.N for n in self.node.children])
+        dist = 1 + root_N
         dist = dist / dist.sum()
         kl_div = np.sum(dist * np.log(dist / self.old_dist))
         self.old_dist = dist
 
+        # Rollouts of every process since the last call
         new_time = time.time()
-        nps = STAT_INTERVAL / (new_time - self.old_time)
+        nodes = self.node.N + self.helper_rolls()
+        nps = (nodes - self.old_nodes) / (new_time - self.old_time)
+        self.old_nodes = nodes
         self.old_time = new_time
         t = new_time - self.start_time
         if kl_div > 0:
             print(f'info string kl {-math.log(kl_div):.1f} root_score {self.node.Q}')
         else:
             print(f'info string kl -inf root_score {self.node.Q}')
+        tt = self.args.tt
+        if tt is not None and tt.hits + tt.misses:
+            print(f'info string tt entries {len(tt.entries)}'
+                  f' hits {tt.hits / (tt.hits + tt.misses):.1%}')
 
         if not pvs:
             depth, node = 0, self.node
             while node.children and node.N >= MIN_PV_VISITS:
                 depth, node = depth + 1, max(node.children, key=lambda n: n.N)
             print(f'info score cp {fastchess.win_to_cp(self.node.Q):.0f} depth {depth}'
-                  f' time {t*1000:.0f} nodes {self.node.N} nps {nps:.0f}')
+                  f' time {t*1000:.0f} nodes {nodes} nps {nps:.0f}')
 
         root = self.node
         real_pvs = min(pvs, len(root.children))
-        root_children = sorted(root.children, key=lambda n: -n.N)
+        order = np.argsort(-root_N, kind='stable')
+        root_children = root.children
         for i in range(real_pvs):
-            node = root_children[i]
+            node = root_children[order[i]]
             pv = [node.move.uci()]
-            Q = node.Q
-            N = node.N
+            Q = root_Q[order[i]]
+            N = int(root_N[order[i]])
             while node.children:
                 node = max(node.children, key=lambda n: n.N)
                 if node.N < MIN_PV_VISITS:
@@ -66,7 +200,7 @@ class MCTS_Controller:
                 pv.append(node.move.uci())
 
             score = fastchess.win_to_cp(Q)
-            extras = f'time {t*1000:.0f} nodes {self.node.N} nps {nps:.0f}' if i == 0 else ''
+            extras = f'time {t*1000:.0f} nodes {nodes} nps {nps:.0f}' if i == 0 else ''
             print(f'info multipv {i+1} score cp {score:.0f} depth {len(pv)} {extras}'
                   f' pv {" ".join(pv)} string pv_nodes {N}')
         return kl_div
@@ -82,7 +216,8 @@ class MCTS_Controller:
             # Check if the board is at one of our children (cheap pondering)
             for node in self.node.children:
                 if node.board == board:
-                    self.node = node
+                    # The other branches are no longer needed
+                    self.node = node.tree.reroot(node.index)
                     if self.args.debug:
                         print('info string Reusing node from ponder.')
                     break
@@ -93,7 +228,7 @@ class MCTS_Controller:
         # still want it to continue playing.
         if not self.node or self.node.board != board or not self.node.children:
             vec = self.args.model.from_scratch(board)
-            self.node = mcts.Node(board, vec, None, 0, self.args)
+            self.node = mcts.Tree(board, vec, self.args).root
             if self.args.debug:
                 print('info string Creating new root node.')
 
@@ -111,36 +246,46 @@ class MCTS_Controller:
         rolls = 0
         start_time = time.time()
         if use_mcts:
-            first = True
-            for i in itertools.count():
-                rolls += 1
-                self.node.rollout()
-                if self.should_stop or \
-                        max_time > 0 and time.time() > start_time + max_time or \
-                        max_rolls > 0 and rolls >= max_rolls:
-                    break
-                if (i+1) % STAT_INTERVAL == 0:
-                    kl_div = self.print_stats(first, pvs)
-                    if min_kldiv > 0 and kl_div < min_kldiv:
+            helpers = self.start_helpers(board)
+            try:
+                first = True
+                reported = 0
+                while True:
+                    rolls += rollout(self.node, self.args.batch)
+                    if self.should_stop or \
+                            max_time > 0 and time.time() > start_time + max_time or \
+                            max_rolls > 0 and rolls + self.helper_rolls() >= max_rolls:
                         break
-                    first = False
+                    if rolls >= reported + STAT_INTERVAL:
+                        reported = rolls
+                        self.collect_helpers()
+                        kl_div = self.print_stats(first, pvs)
+                        if min_kldiv > 0 and kl_div < min_kldiv:
+                            break
+                        first = False
+            finally:
+                self.collect_helpers(helpers)
+            rolls += self.helper_rolls()
 
-        # Pick best or random child
+        # Pick best or random child, by the visits of every process
+        children = self.node.children
+        visits, _ = self.root_stats()
         if temperature:
             if use_mcts:
-                counts = [(n.N / self.node.N)**(1 / temperature)
-                          for n in self.node.children]
+                counts = (visits / visits.sum())**(1 / temperature)
             else:
-                counts = [n.P**(1 / temperature) for n in self.node.children]
-            node = random.choices(self.node.children, weights=counts)[0]
+                counts = [n.P**(1 / temperature) for n in children]
+            node = random.choices(children, weights=counts)[0]
             if self.args.debug:
-                o = sorted(self.node.children, key=lambda n: -n.N).index(node)
+                o = sorted(children, key=lambda n: -n.N).index(node)
                 # From https://codegolf.stackexchange.com/questions/4707#answer-4712
                 ordinal = (lambda n: "%d%s" % (n, "tsnrhtdd"[
                            (n / 10 % 10 != 1) * (n % 10 < 4) * n % 10::4]))(o + 1)
             self.node = node
         else:
-            self.node = max(self.node.children, key=lambda n: n.N)
+            self.node = children[int(np.argmax(visits))]
+        self.helpers = {}
+        self.helper_counts = {}
 
         stats = Stats(kl_div, rolls, time.time() - start_time)
         return self.node, stats
@@ -48,6 +48,21 @@ def prepare_example(board, move, occ=False):
 EVAL_INDEX = 0
 COUNT_INDEX = 1
 
+_SHIFTS = np.arange(64, dtype=np.uint64)
+
+
+def bits(masks):
+    ''' The 64 bits of square masks as boolean arrays, indexed by square. '''
+    masks = np.asarray(masks, dtype=np.uint64)[..., None]
+    return (masks >> _SHIFTS) & np.uint64(1) == 1
+
+
+def piece_type_array(board):
+    ''' The piece type on each square, 0 where empty. '''
+    occupied = bits([0, board.pawns, board.knights, board.bishops,
+                     board.rooks, board.queens, board.kings])
+    return np.argmax(occupied, axis=0)
+
 
 class Model:
     def __init__(self, path):
@@ -103,6 +118,8 @@ class Model:
         # Adding 2 to the move ids, since the first entry will be the count,
         # and the second entry will be the evaluation
         self.move_to_id = {move: i + 2 for i, move in enumerate(self.moves)}
+        # Black moves are looked up mirrored, so do the mirroring once here
+        self.mirror_move_to_id = {mirror_move(move): i for move, i in self.move_to_id.items()}
 
     def get_eval(self, vec, board, debug=False):
         """ Returns a single score relative to board.turn """
@@ -125,6 +142,14 @@ class Model:
 
         return pst.to_win(cp)
 
+    def get_eval_batch(self, vecs, turns, checks):
+        """ Like get_eval for a stack of vectors, given the turn and whether
+            the side to move is in check in each of the boards. """
+        turns = np.asarray(turns, dtype=int)
+        cp = vecs[np.arange(len(vecs)), 1 - turns, EVAL_INDEX]
+        cp = cp + pst.check * np.asarray(checks) + pst.turn
+        return pst.to_win(cp)
+
     def get_top_k(self, vec, k):
         for i in np.argpartition(vec, -k)[-k:]:
             yield vec[i], self.moves[i]
@@ -134,11 +159,32 @@ class Model:
     def apply(self, vec, board, move):
         """ Should be called prior to pushing move to board.
             Applies the move to the vector. """
+        for sign, row in self.deltas(board, move):
+            if sign > 0:
+                vec += row
+            else:
+                vec -= row
+        return vec
+
+    def apply_batch(self, vecs, deltas, columns=slice(None)):
+        """ Applies many moves at once. vecs is a stack of vectors, or of the
+            given columns of them, and deltas[i] the deltas of the move to
+            apply to vecs[i]. """
+        index = [i for i, d in enumerate(deltas) for _ in d]
+        if index:
+            rows = np.stack([sign * row[:, columns] for d in deltas for sign, row in d])
+            np.add.at(vecs, index, rows)
+        return vecs
+
+    def deltas(self, board, move):
+        """ Should be called prior to pushing move to board.
+            The (sign, row) pairs that make up the change of the vector. """
+        deltas = []
 
         # Remove from square.
         piece_type = board.piece_type_at(move.from_square)
         color = board.turn
-        vec -= self.piece_to_vec[piece_type, color, move.from_square]
+        deltas.append((-1, self.piece_to_vec[piece_type, color, move.from_square]))
 
         # Update castling rights.
         old_castling_rights = board.clean_castling_rights()
@@ -148,44 +194,42 @@ class Model:
             new_castling_rights &= ~chess.BB_RANK_1 if color else ~chess.BB_RANK_8
         # Castling rights can only have been removed
         for sq in chess.scan_forward(old_castling_rights ^ new_castling_rights):
-            vec -= self.castling[sq]
+            deltas.append((-1, self.castling[sq]))
 
         # Remove pawns captured en passant.
         if piece_type == chess.PAWN and move.to_square == board.ep_square:
             down = -8 if board.turn == chess.WHITE else 8
             capture_square = board.ep_square + down
-            vec -= self.piece_to_vec[chess.PAWN, not board.turn, capture_square]
+            deltas.append((-1, self.piece_to_vec[chess.PAWN, not board.turn, capture_square]))
 
         # Move rook during castling.
         if piece_type == chess.KING:
             if move.from_square == chess.E1:
                 if move.to_square == chess.G1:
-                    vec -= self.piece_to_vec[chess.ROOK, color, chess.H1]
-                    vec += self.piece_to_vec[chess.ROOK, color, chess.F1]
+                    deltas.append((-1, self.piece_to_vec[chess.ROOK, color, chess.H1]))
+                    deltas.append((1, self.piece_to_vec[chess.ROOK, color, chess.F1]))
                 if move.to_square == chess.C1:
-                    vec -= self.piece_to_vec[chess.ROOK, color, chess.A1]
-                    vec += self.piece_to_vec[chess.ROOK, color, chess.D1]
+                    deltas.append((-1, self.piece_to_vec[chess.ROOK, color, chess.A1]))
+                    deltas.append((1, self.piece_to_vec[chess.ROOK, color, chess.D1]))
             if move.from_square == chess.E8:
                 if move.to_square == chess.G8:
-                    vec -= self.piece_to_vec[chess.ROOK, color, chess.H8]
-                    vec += self.piece_to_vec[chess.ROOK, color, chess.F8]
+                    deltas.append((-1, self.piece_to_vec[chess.ROOK, color, chess.H8]))
+                    deltas.append((1, self.piece_to_vec[chess.ROOK, color, chess.F8]))
                 if move.to_square == chess.C8:
-                    vec -= self.piece_to_vec[chess.ROOK, color, chess.A8]
-                    vec += self.piece_to_vec[chess.ROOK, color, chess.D8]
+                    deltas.append((-1, self.piece_to_vec[chess.ROOK, color, chess.A8]))
+                    deltas.append((1, self.piece_to_vec[chess.ROOK, color, chess.D8]))
 
         # Capture
         captured_piece_type = board.piece_type_at(move.to_square)
         if captured_piece_type:
-            vec -= self.piece_to_vec[captured_piece_type, not color, move.to_square]
+            deltas.append((-1, self.piece_to_vec[captured_piece_type, not color, move.to_square]))
 
         # Put the piece on the target square.
-        vec += self.piece_to_vec[move.promotion or piece_type, color, move.to_square]
-        return vec
+        deltas.append((1, self.piece_to_vec[move.promotion or piece_type, color, move.to_square]))
+        return deltas
 
     def get_clean_moves(self, board, vec, legal_t=1, cap_t=2, chk_t=2, debug=False):
         ''' Returns a list of (prior, move) pairs containing all legal moves. '''
-        moves = []
-        scores = []
         vec = vec[1 - int(board.turn)]
 
         if debug:
@@ -200,44 +244,97 @@ class Model:
         # Another approach is to use top_k to get the moves and simply trust
         # that they are legal.
         # self.model.top_k(self.vec)
-
-        for m in board.legal_moves:
-            moves.append(m)
-            prior = vec[self.move_to_id[m if board.turn else mirror_move(m)]]
-            scores.append(prior)
+        moves = list(board.legal_moves)
+        move_to_id = self.move_to_id if board.turn else self.mirror_move_to_id
+        ids = np.fromiter((move_to_id[m] for m in moves), dtype=np.int64, count=len(moves))
 
         # A fast text model is normalized.
         # We keep the word count in the first entry.
         n = vec[COUNT_INDEX]
-        scores = np.array(scores) / n
-
-        for i, m in enumerate(moves):
-            prior = scores[i]
-            prior = max(prior, legal_t)
-
-            # Hack: We make sure that checks and captures are always included,
-            # and that no move has a completely non-existent prior.
-            # Add some bonus for being a legal move and check or cap.
-            # These are basically move extensions, like in classical engines.
-            # Maybe other extensions would be useful too, like passed pawn or
-            # recapture extensions: https://www.chessprogramming.org/Extensions
-            if cap_t > prior and board.is_capture(m):
-                prior = cap_t
-
-            # TODO: There might be a faster way, inspired by the is_into_check method.
-            # or _attackers_mask. Some sort of pseudo-is-check should be sufficient.
-            if chk_t > prior:
-                board.push(m)
-                if board.is_check():
-                    prior = chk_t
-                board.pop()
-
-            scores[i] = prior
+        scores = np.maximum(vec[ids] / n, legal_t)
+
+        # Hack: We make sure that checks and captures are always included,
+        # and that no move has a completely non-existent prior.
+        # Add some bonus for being a legal move and check or cap.
+        # These are basically move extensions, like in classical engines.
+        # Maybe other extensions would be useful too, like passed pawn or
+        # recapture extensions: https://www.chessprogramming.org/Extensions
+        # A bonus no higher than legal_t can't change a prior, so the masks
+        # are only worked out when they matter.
+        if cap_t > legal_t or chk_t > legal_t:
+            to_squares = np.fromiter((m.to_square for m in moves), dtype=np.int64, count=len(moves))
+            en_passant = np.zeros(len(moves), dtype=bool)
+            if board.ep_square is not None or chk_t > legal_t:
+                from_squares = np.fromiter((m.from_square for m in moves), dtype=np.int64, count=len(moves))
+                piece_types = piece_type_array(board)
+            if board.ep_square is not None:
+                en_passant = (piece_types[from_squares] == chess.PAWN) & (to_squares == board.ep_square)
+
+        if cap_t > legal_t:
+            captures = bits(board.occupied_co[not board.turn])[to_squares] | en_passant
+            scores = np.where(captures, np.maximum(scores, cap_t), scores)
+
+        if chk_t > legal_t:
+            promotions = np.fromiter((m.promotion or 0 for m in moves), dtype=np.int64, count=len(moves))
+            lands_as = np.where(promotions > 0, promotions, piece_types[from_squares])
+            checks = self.check_table(board)[lands_as, to_squares]
+            # A promoting pawn may have been blocking its own line to the king
+            for i in np.flatnonzero(promotions):
+                occupied = board.occupied & ~chess.BB_SQUARES[from_squares[i]]
+                checks[i] = self.check_table(board, occupied)[promotions[i], to_squares[i]]
+            discovered = self.discovered_rays(board)[from_squares]
+            checks |= (discovered != 0) & ((discovered >> to_squares.astype(np.uint64)) & np.uint64(1) == 0)
+            # The tables miss checks by the castling rook and by uncovering a
+            # line through the pawn captured en passant, there are few such moves
+            castling = (lands_as == chess.KING) & (np.abs(to_squares - from_squares) == 2)
+            for i in np.flatnonzero(castling | en_passant):
+                checks[i] = board.gives_check(moves[i])
+            scores = np.where(checks, np.maximum(scores, chk_t), scores)
 
         scores = np.exp(scores - np.max(scores))
         scores /= np.sum(scores)
         return zip(scores, moves)
 
+    def check_table(self, board, occupied=None):
+        ''' A (7, 64) boolean table of the squares each piece type of board.turn
+            gives direct check from, given the `occupied` squares, by default
+            those of the board. '''
+        king = board.king(not board.turn)
+        if king is None:
+            return np.zeros((7, 64), dtype=bool)
+        if occupied is None:
+            occupied = board.occupied
+        diagonal = chess.BB_DIAG_ATTACKS[king][chess.BB_DIAG_MASKS[king] & occupied]
+        straight = chess.BB_RANK_ATTACKS[king][chess.BB_RANK_MASKS[king] & occupied] \
+            | chess.BB_FILE_ATTACKS[king][chess.BB_FILE_MASKS[king] & occupied]
+        return bits([0,
+                     chess.BB_PAWN_ATTACKS[not board.turn][king],
+                     chess.BB_KNIGHT_ATTACKS[king],
+                     diagonal,
+                     straight,
+                     diagonal | straight,
+                     0])
+
+    def discovered_rays(self, board):
+        ''' For each of our pieces that is the only blocker between one of our
+            sliders and their king, the line it can move along without
+            uncovering the check (as a mask), 0 for every other square.
+            Only discoveries by the moving piece are included, not those by
+            the rook of a castling move or by the pawn captured en passant. '''
+        rays = np.zeros(64, dtype=np.uint64)
+        king = board.king(not board.turn)
+        if king is None:
+            return rays
+        us = board.occupied_co[board.turn]
+        snipers = (chess.BB_RANK_ATTACKS[king][0] | chess.BB_FILE_ATTACKS[king][0]) \
+            & (board.rooks | board.queens) & us
+        snipers |= chess.BB_DIAG_ATTACKS[king][0] & (board.bishops | board.queens) & us
+        for sniper in chess.scan_forward(snipers):
+            blockers = chess.between(king, sniper) & board.occupied
+            if blockers and chess.popcount(blockers) == 1 and blockers & us:
+                rays[chess.lsb(blockers)] = chess.ray(king, sniper)
+        return rays
+
     def _eval_from_scratch(self, vec, board):
         # We first calculate the value relative to white
         res = 0
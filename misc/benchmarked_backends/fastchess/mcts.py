@@ -1,5 +1,6 @@
 import sys
 import chess
+import chess.polyglot
 import numpy as np
 import math
 from math import sqrt
@@ -7,46 +8,242 @@ import random
 import fastchess
 import pst
 from fastchess import mirror_move
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 
-Args = namedtuple('MctsArgs', ['model', 'debug', 'cpuct', 'legal_t', 'cap_t', 'chk_t'])
+# tt is an optional TranspositionTable shared by every search,
+# threads the number of processes searching each move and
+# batch the number of leaves evaluated together.
+Args = namedtuple('MctsArgs', ['model', 'debug', 'cpuct', 'legal_t', 'cap_t', 'chk_t', 'tt', 'threads', 'batch'],
+                  defaults=(None, 1, 1))
 
 
-class Node:
-    """Monte Carlo tree searcher. First rollout the tree then choose a move."""
+def encode_move(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code):
+    code = int(code)
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+ZOBRIST = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+def zobrist_piece(piece_type, color, square):
+    return ZOBRIST.array[64 * ((piece_type - 1) * 2 + int(color)) + square]
+
+
+def push_key(key, board, move):
+    """ Pushes `move` to `board`, returning the Zobrist hash after the move
+        given `key`, the hash before it. Much cheaper than hashing from scratch. """
+    color = board.turn
+    piece_type = board.piece_type_at(move.from_square)
+    key ^= ZOBRIST.hash_castling(board) ^ ZOBRIST.hash_ep_square(board)
+    key ^= zobrist_piece(piece_type, color, move.from_square)
+    if board.is_castling(move):
+        rank = chess.square_rank(move.from_square) * 8
+        kingside = board.is_kingside_castling(move)
+        if board.piece_type_at(move.to_square) == chess.ROOK:
+            rook = move.to_square  # Chess960 style, the king takes the rook
+        else:
+            rook = rank + (7 if kingside else 0)
+        key ^= zobrist_piece(chess.ROOK, color, rook)
+        key ^= zobrist_piece(chess.ROOK, color, rank + (5 if kingside else 3))
+        key ^= zobrist_piece(chess.KING, color, rank + (6 if kingside else 2))
+    else:
+        captured = board.piece_type_at(move.to_square)
+        if captured:
+            key ^= zobrist_piece(captured, not color, move.to_square)
+        elif piece_type == chess.PAWN and move.to_square == board.ep_square:
+            down = -8 if color == chess.WHITE else 8
+            key ^= zobrist_piece(chess.PAWN, not color, move.to_square + down)
+        key ^= zobrist_piece(move.promotion or piece_type, color, move.to_square)
+    board.push(move)
+    return key ^ ZOBRIST.hash_castling(board) ^ ZOBRIST.hash_ep_square(board) ^ ZOBRIST.array[780]
+
+
+class TranspositionTable:
+    """ Model evaluations and priors by Zobrist hash, so nodes reaching the same
+        position (like move order swaps) share them. Holds at most `size`
+        positions, replacing the least recently used. """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+# Only the evaluation is needed at a leaf, so only the columns up to it are applied
+EVAL_COLUMNS = slice(0, fastchess.EVAL_INDEX + 1)
+
 
-    def __init__(self, parent_board, parent_vec, move, prior, args):
-        """ Make a new game node representing the state of pushing `move` to `parent_board`.
-            If `move` is None, the node is assumed to be a root node at `parent_board`. """
-        self.children = []
+def eval_vec(vec, deltas):
+    """ The evaluation columns of `vec` with the move `deltas` applied. """
+    vec = vec[:, EVAL_COLUMNS].copy()
+    for sign, row in deltas:
+        if sign > 0:
+            vec += row[:, EVAL_COLUMNS]
+        else:
+            vec -= row[:, EVAL_COLUMNS]
+    return vec
+
+
+class Tree:
+    """Monte Carlo search tree, stored as arrays indexed by node id.
+       The children of a node are contiguous, starting at first_child.
+       Visited nodes keep their board, like a tree of node objects, but only
+       nodes visited at least `vec_visits` times keep their vector, so only the
+       top of the tree has them. Descents select children by index alone, and
+       the vector of the node being expanded is applied from its closest
+       ancestor that kept one, usually a few plies up. """
+
+    # The per-node arrays and the value of unused entries
+    FIELDS = (('P', 0), ('Q', 1), ('N', 0), ('parent', -1), ('first_child', -1),
+              ('n_children', 0), ('move', 0), ('game_over', False), ('key', 0))
+
+    def __init__(self, board, vec, args, capacity=1024, vec_visits=8):
+        """ Make a new tree whose root is `board`. """
         self.args = args
-        self.move = move
-        self.parent_board = parent_board
-        self.parent_vec = parent_vec
-        # We expand this as the node is visited
-        self.board = None
-        self.vec = None
+        self.vec_visits = vec_visits
+        self.size = 0
+
         # Statistics. P is prior, Q is avg reward and N is number of visits.
-        self.P = prior
-        self.Q = 1
-        self.N = 0
-        self.game_over = None
-        # If we are at the root, make a fake first rollout,
-        # just because the parent_board is actually the reeal board, and it's
-        # confusing otherwise.
-        if move is None:
-            # Could do this using null-move?...
-            self.board = parent_board
-            self.vec = parent_vec
-            # The Q value at the root doesn't really matter...
-            self.Q, self.game_over = self.eval(self.vec, self.board)
-            self.N = 1
-            # Even if we think it's game-over (like a repetition), we continue to
-            # play of people ask us to.
-            self.game_over = False
-
-    def eval(self, vec, board):
+        self.P = np.zeros(capacity, dtype=np.float32)
+        self.Q = np.ones(capacity, dtype=np.float64)
+        self.N = np.zeros(capacity, dtype=np.int32)
+        self.parent = np.full(capacity, -1, dtype=np.int32)
+        self.first_child = np.full(capacity, -1, dtype=np.int32)
+        self.n_children = np.zeros(capacity, dtype=np.int16)
+        self.move = np.zeros(capacity, dtype=np.int16)
+        self.game_over = np.zeros(capacity, dtype=bool)
+        # Zobrist hashes for the transposition table, 0 until computed
+        self.key = np.zeros(capacity, dtype=np.uint64)
+        # The boards of the visited nodes and the vectors of the nodes that keep them
+        self.boards = {}
+        self.vecs = {}
+        # The (index, vector) of the node expanded in the current rollout
+        self.last = None
+        # Node ids on the path of the current rollout, and the sign of the
+        # leaf value k plies up the path at signs[k]
+        self.path = np.empty(64, dtype=np.int32)
+        self.signs = np.resize([1., -1.], 65)
+
+        # The root gets a fake first rollout, since we already have its board.
+        root = self.allocate(1)
+        # Don't copy the entire move stack, it just takes up memory.
+        # We do need some though, to prevent repetition draws.
+        # Half-move clock is copied separately.
+        self.boards[root] = board.copy(stack=3)
+        self.vecs[root] = vec
+        # The Q value at the root doesn't really matter...
+        self.Q[root], _ = self.eval(root, vec, board)
+        self.N[root] = 1
+        # Even if we think it's game-over (like a repetition), we continue to
+        # play of people ask us to.
+        self.game_over[root] = False
+
+    @property
+    def root(self):
+        return Node(self, 0)
+
+    def allocate(self, count):
+        """ Reserves `count` contiguous node ids, growing the arrays if needed. """
+        start = self.size
+        self.size += count
+        if self.size > len(self.N):
+            capacity = max(2 * len(self.N), self.size)
+            for name, fill in self.FIELDS:
+                old = getattr(self, name)
+                new = np.full(capacity, fill, dtype=old.dtype)
+                new[:len(old)] = old
+                setattr(self, name, new)
+        return start
+
+    def board(self, index):
+        """ Replays the moves from the closest ancestor that kept its board to
+            get the board at `index`. """
+        moves = []
+        while index not in self.boards:
+            moves.append(decode_move(self.move[index]))
+            index = int(self.parent[index])
+        board = self.boards[index].copy()
+        for move in reversed(moves):
+            board.push(move)
+        return board
+
+    def children(self, index):
+        first = self.first_child[index]
+        if first < 0:
+            return range(0)
+        return range(first, first + self.n_children[index])
+
+    def state(self, index):
+        """ The board and vector at `index`, its vector applied from the
+            closest ancestor that kept one, or the node expanded in the current
+            rollout. Nodes on the way visited at least vec_visits times keep
+            their vector from now on. Neither may be changed by the caller. """
+        nodes = []
+        while index not in self.vecs and (self.last is None or index != self.last[0]):
+            nodes.append(index)
+            index = int(self.parent[index])
+        vec = self.vecs[index] if index in self.vecs else self.last[1]
+
+        kept = True
+        for child in reversed(nodes):
+            move = decode_move(self.move[child])
+            vec = self.args.model.apply(vec.copy() if kept else vec, self.boards[index], move)
+            index, kept = child, False
+            # The visit of the current rollout isn't counted before its backup
+            if self.N[index] + 1 >= self.vec_visits:
+                self.vecs[index] = vec
+                kept = True
+        return self.boards[index], vec
+
+    def leaf(self, index):
+        """ The board at leaf `index`, which it keeps from now on, with the
+            vector of its parent and the deltas of its move, as only its
+            evaluation needs applying. """
+        if index in self.vecs:
+            return self.boards[index], self.vecs[index], []
+        parent = int(self.parent[index])
+        board = self.boards[parent]
+        move = decode_move(self.move[index])
+        # Don't copy the entire move stack, it just takes up memory.
+        # We do need some though, to prevent repetition draws.
+        # Half-move clock is copied separately.
+        child_board = board.copy(stack=3)
+        if self.args.tt is not None:
+            self.key[index] = push_key(self.position_key(parent, board), child_board, move)
+        else:
+            child_board.push(move)
+        self.boards[index] = child_board
+        return child_board, self.state(parent)[1], self.args.model.deltas(board, move)
+
+    def position_key(self, index, board):
+        if not self.key[index]:
+            self.key[index] = chess.polyglot.zobrist_hash(board)
+        return int(self.key[index])
+
+    def known_eval(self, index, board):
+        """ The value of `index` if it doesn't need the model, because the game
+            is over or the position is in the transposition table. Else None. """
         v = {'1-0': 1, '0-1': -1, '1/2-1/2': 0, '*': None}[board.result()]
         if v is not None:
             return (v if board.turn == chess.WHITE else -v), True
@@ -54,59 +251,272 @@ class Node:
         # but even then it doesn't quite do what we want.
         if board.is_repetition(count=2):
             return 0, True
-        return self.args.model.get_eval(vec, board), False
+        tt = self.args.tt
+        if tt is not None:
+            entry = tt.get(self.position_key(index, board))
+            if entry is not None:
+                return entry[0], False
+        return None
+
+    def store_eval(self, index, value):
+        # Entries are [eval, priors, moves], the priors are filled in on expansion
+        if self.args.tt is not None:
+            self.args.tt.put(int(self.key[index]), [value, None, None])
+
+    def eval(self, index, vec, board):
+        known = self.known_eval(index, board)
+        if known is not None:
+            return known
+        value = self.args.model.get_eval(vec, board)
+        self.store_eval(index, value)
+        return value, False
+
+    def priors(self, index, board, vec):
+        """ The priors and encoded moves of the children of `index`. """
+        tt = self.args.tt
+        if tt is not None:
+            key = self.position_key(index, board)
+            entry = tt.get(key)
+            if entry is not None and entry[1] is not None:
+                return entry[1], entry[2]
+
+        priors = list(self.args.model.get_clean_moves(
+            board,
+            vec,
+            debug=self.args.debug,
+            legal_t=self.args.legal_t,
+            cap_t=self.args.cap_t,
+            chk_t=self.args.chk_t,
+        ))
+        P = np.array([p for p, _ in priors], dtype=np.float32)
+        moves = np.array([encode_move(move) for _, move in priors], dtype=np.int16)
+
+        if tt is not None:
+            if entry is None:
+                entry = [self.args.model.get_eval(vec, board), None, None]
+                tt.put(key, entry)
+            entry[1], entry[2] = P, moves
+        return P, moves
+
+    def expand(self, index, board, vec):
+        P, moves = self.priors(index, board, vec)
+        first = self.allocate(len(P))
+        end = first + len(P)
+        self.P[first:end] = P
+        self.move[first:end] = moves
+        self.parent[first:end] = index
+        self.first_child[index] = first
+        self.n_children[index] = len(P)
+
+    def select(self, first, count, visits):
+        """ The child maximizing the PUCT score, of the `count` children from
+            `first` of a node visited `visits` times. """
+        s = slice(first, first + count)
+        sqrtN = self.args.cpuct * math.sqrt(visits)
+        return first + int((-self.Q[s] + self.P[s] * sqrtN / (1 + self.N[s])).argmax())
+
+    def descend(self, index, pending=()):
+        """ Walks down from `index` to a leaf by index alone, recording the
+            path, leaf included, in self.path. Only the node it expands needs
+            its board and vector. The visits are counted by the backup.
+            Returns the depth of the leaf. Nodes in `pending` are taken as leaves. """
+        N, first_child, game_over = self.N, self.first_child, self.game_over
+        path = self.path
+        depth = 0
+        self.last = None
+
+        while True:
+            if depth == len(path):
+                self.path = path = np.concatenate([path, np.empty_like(path)])
+                self.signs = np.resize([1., -1.], 2 * depth + 1)
+            path[depth] = index
+            n = int(N[index])
+
+            # Game over won't be set before the board is evaluated.
+            # If first visit, the board needs evaluating.
+            if n == 0 or game_over[index] or index in pending:
+                return depth
+
+            # If second visit, expand children
+            first = int(first_child[index])
+            if first < 0:
+                board, vec = self.state(index)
+                self.expand(index, board, vec)
+                # Its child is the leaf, one ply from here
+                self.last = (index, vec)
+                # The arrays may have been reallocated
+                N, first_child, game_over = self.N, self.first_child, self.game_over
+                first = int(first_child[index])
+
+            # Find best child, counting this visit
+            index = self.select(first, int(self.n_children[index]), n + 1)
+            depth += 1
+
+    def backup(self, path, value, loss=False):
+        """ Counts the visits along `path` to a leaf with value `value`, and
+            updates the average reward of the nodes above the leaf, flipping
+            the sign every ply. With `loss`, the rollout is taken as lost for
+            the player of every node above the leaf instead, until the leaf
+            is evaluated. """
+        self.N[path] += 1
+        above = path[:-1]
+        n = self.N[above]
+        reward = 1 if loss else self.signs[len(above):0:-1] * value
+        self.Q[above] = ((n - 1) * self.Q[above] + reward) / n
+
+    def rollout(self, index):
+        """ Returns the leaf value relative to the current player of the node.
+            Walks down with a loop, recording the path, and backs the value up
+            the whole path at once. """
+        depth = self.descend(index)
+        leaf = int(self.path[depth])
+        if not self.game_over[leaf]:
+            board, vec, deltas = self.leaf(leaf)
+            self.Q[leaf], self.game_over[leaf] = self.eval(leaf, eval_vec(vec, deltas), board)
+        value = self.Q[leaf]
+        self.backup(self.path[:depth + 1], value)
+
+        # The value relative to the player of the first node
+        return -value if depth % 2 else value
+
+    def rollout_batch(self, index, count):
+        """ Up to `count` rollouts from `index`, whose leaves are evaluated
+            together. Nodes on the way to a leaf that waits for its evaluation
+            get a virtual loss, so the next rollouts look elsewhere. Stops early
+            if a rollout still reaches a waiting leaf. Returns the number of
+            rollouts done. """
+        pending = {}
+        paths, parent_vecs, deltas, turns, checks = [], [], [], [], []
+        done = 0
+
+        for _ in range(count):
+            depth = self.descend(index, pending)
+            path = self.path[:depth + 1].copy()
+            leaf = int(path[-1])
+            if leaf in pending:
+                # Its visit is counted when the batch is evaluated
+                break
+
+            known = None
+            if not self.game_over[leaf]:
+                board, parent_vec, leaf_deltas = self.leaf(leaf)
+                known = self.known_eval(leaf, board)
+                if known is None:
+                    pending[leaf] = len(paths)
+                    paths.append(path)
+                    parent_vecs.append(parent_vec)
+                    deltas.append(leaf_deltas)
+                    turns.append(board.turn)
+                    checks.append(board.is_check())
+                    self.backup(path, None, loss=True)
+                else:
+                    self.Q[leaf], self.game_over[leaf] = known
+
+            if known is not None or self.game_over[leaf]:
+                self.backup(path, self.Q[leaf])
+                done += 1
+
+        if pending:
+            model = self.args.model
+            vecs = model.apply_batch(np.stack([vec[:, EVAL_COLUMNS] for vec in parent_vecs]), deltas, EVAL_COLUMNS)
+            values = model.get_eval_batch(vecs, turns, checks)
+            N, Q = self.N, self.Q
+            for leaf, i in pending.items():
+                value = values[i]
+                Q[leaf] = value
+                self.store_eval(leaf, value)
+                # Replace the virtual loss by the value
+                above = paths[i][:-1]
+                Q[above] += (self.signs[len(above):0:-1] * value - 1) / N[above]
+            done += len(pending)
+        return done
+
+    def reroot(self, index):
+        """ Makes `index` the root, once its move has been played, and compacts
+            the arrays to its subtree, in breadth first order so the children
+            of a node stay contiguous. Returns the new root node. """
+        # The new root may not have been visited enough to keep its own board and vector
+        if index not in self.boards:
+            self.boards[index] = self.board(index).copy(stack=3)
+        self.last = None
+        _, self.vecs[index] = self.state(index)
+
+        # Old ids of the subtree, level by level
+        levels = [np.array([index])]
+        while True:
+            level = levels[-1]
+            level = level[self.first_child[level] >= 0]
+            counts = self.n_children[level].astype(np.int64)
+            if not counts.sum():
+                break
+            starts = self.first_child[level]
+            levels.append(np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                          + np.repeat(starts, counts))
+        order = np.concatenate(levels)
+        new_id = np.full(self.size, -1, dtype=np.int32)
+        new_id[order] = np.arange(len(order))
+
+        size = len(order)
+        for name, fill in self.FIELDS:
+            values = getattr(self, name)
+            values[:size] = values[order]
+            values[size:] = fill
+        self.parent[1:size] = new_id[self.parent[1:size]]
+        self.parent[0] = -1
+        expanded = self.first_child[:size] >= 0
+        self.first_child[:size][expanded] = new_id[self.first_child[:size][expanded]]
+        self.boards = {int(new_id[node]): board for node, board in self.boards.items()
+                       if new_id[node] >= 0}
+        self.vecs = {int(new_id[node]): vec for node, vec in self.vecs.items()
+                     if new_id[node] >= 0}
+
+        self.size = size
+        return Node(self, 0)
+
+
+class Node:
+    """ A handle on one node of a Tree, with the attributes of a tree of node objects. """
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    @property
+    def P(self):
+        return float(self.tree.P[self.index])
+
+    @property
+    def Q(self):
+        return float(self.tree.Q[self.index])
+
+    @property
+    def N(self):
+        return int(self.tree.N[self.index])
+
+    @property
+    def move(self):
+        return decode_move(self.tree.move[self.index]) if self.index > 0 else None
+
+    @property
+    def board(self):
+        return self.tree.board(self.index)
+
+    @property
+    def children(self):
+        return [Node(self.tree, child) for child in self.tree.children(self.index)]
 
     def rollout(self):
         """ Returns the leaf value relative to the current player of the node. """
+        return self.tree.rollout(self.index)
 
-        self.N += 1
-
-        # Game over won't be set before the board is evaluated.
-        if self.game_over:
-            return self.Q
-
-        # If first visit, expand board
-        if self.N == 1:
-            self.vec = self.args.model.apply(
-                self.parent_vec.copy(), self.parent_board, self.move)
-            # Don't copy the entire move stack, it just takes up memory.
-            # We do need some though, to prevent repetition draws.
-            # Half-move clock is copied separately.
-            # TODO: Some loops are longer than three moves. It would be nice to
-            # be able to copy until the last unrepeatable move.
-            self.board = self.parent_board.copy(stack=3)
-            self.board.push(self.move)
-
-            self.Q, self.game_over = self.eval(self.vec, self.board)
-            return self.Q
-
-        # If second visit, expand children
-        if self.N == 2:
-            for p, move in self.args.model.get_clean_moves(
-                    self.board,
-                    self.vec,
-                    debug=self.args.debug,
-                    legal_t=self.args.legal_t,
-                    cap_t=self.args.cap_t,
-                    chk_t=self.args.chk_t,
-            ):
-                self.children.append(Node(self.board, self.vec, move, p, self.args))
-
-        # Find best child (small optimization, since this is actually a bottle neck)
-        # TODO: Even now, this is still pretty slow
-        # _, node = max((-n.Q + CPUCT * n.P * sqrtN / (1 + n.N), n) for n in self.children)
-        # is better, but it fails when two nodes have the same score...
-        sqrtN = self.args.cpuct * math.sqrt(self.N)
-        node = max(self.children,
-                   key=lambda n: -n.Q + n.P * sqrtN / (1 + n.N))
-
-        # Visit it and flip the sign
-        s = -node.rollout()
-        # Update our own average reward
-        self.Q = ((self.N - 1) * self.Q + s) / self.N
-
-        # TODO: Could update prior to safe division?
-        # self.P = (self.N - 1) * self.P / self.N
-
-        # Propagate the value further up the tree
-        return s
+    def rollout_batch(self, count):
+        """ Up to `count` rollouts with their leaves evaluated together.
+            Returns the number of rollouts done. """
+        return self.tree.rollout_batch(self.index, count)
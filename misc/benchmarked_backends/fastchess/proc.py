@@ -20,26 +20,31 @@ from pystreams.pystreams import Stream
     # - occupied squares (makes it easier to play legally)
     # - whether the king is in check
     # - attackers/defenders fr each square
-def binary_encode(board):
-    """ Returns the board as a binary vector, for eval prediction purposes. """
-    rows = []
-    for color in [chess.WHITE, chess.BLACK]:
-        for ptype in range(chess.PAWN, chess.KING + 1):
-            mask = board.pieces_mask(ptype, color)
-            rows.append(list(map(int, bin(mask)[2:].zfill(64))))
-    ep = [0] * 64
+# 12 piece masks, the ep square and 6 flags
+FEATURES = 12 * 64 + 64 + 6
+
+def binary_encode(board, out=None):
+    """ Returns the board as a binary vector, for eval prediction purposes.
+        Writes into `out`, a row of FEATURES values, if given. """
+    if out is None:
+        out = np.zeros(FEATURES, dtype=int)
+    # Big endian bytes unpack most significant bit first, like bin(mask).zfill(64)
+    masks = np.array([board.pieces_mask(ptype, color)
+                      for color in [chess.WHITE, chess.BLACK]
+                      for ptype in range(chess.PAWN, chess.KING + 1)], dtype='>u8')
+    out[:768] = np.unpackbits(masks.view(np.uint8))
+    out[768:832] = 0
     if board.ep_square:
-        ep[board.ep_square] = 1
-    rows.append(ep)
-    rows.append([
-        int(board.turn),
-        int(bool(board.castling_rights & chess.BB_A1)),
-        int(bool(board.castling_rights & chess.BB_H1)),
-        int(bool(board.castling_rights & chess.BB_A8)),
-        int(bool(board.castling_rights & chess.BB_H8)),
-        int(board.is_check())
-    ])
-    return np.concatenate(rows)
+        out[768 + board.ep_square] = 1
+    out[832:] = (
+        board.turn,
+        bool(board.castling_rights & chess.BB_A1),
+        bool(board.castling_rights & chess.BB_H1),
+        bool(board.castling_rights & chess.BB_A8),
+        bool(board.castling_rights & chess.BB_H8),
+        board.is_check()
+    )
+    return out
 
 def encode_move(move):
     if move.promotion:
@@ -58,6 +63,31 @@ def process(node):
     #return sp.csr_matrix(ar)
     return ar
 
+def featurize(game):
+    """ Walks the mainline of game once, returning the features of the position
+        before every move, one row per ply, and the (score, move) labels of the
+        same plies, where score is the result for the player making the move. """
+    moves = list(game.mainline_moves())
+    features = np.zeros((len(moves), FEATURES), dtype=int)
+    labels = np.zeros((len(moves), 2))
+    res = game.headers['Result']
+    board = game.board()
+    for i, move in enumerate(moves):
+        binary_encode(board, features[i])
+        score = 0
+        if res == '1-0': score = int(board.turn)
+        elif res == '0-1': score = int(not board.turn)
+        elif res == '1/2-1/2': score = 1/2
+        labels[i] = score, encode_move(move)
+        board.push(move)
+    return features, labels
+
+def process_game(game):
+    """ The rows of process for every mainline node of game, without replaying
+        the game for each of them. """
+    features, labels = featurize(game)
+    return np.hstack((features, labels))
+
 def get_games(path, max_size=None):
     import chess.pgn
     games = iter(lambda: chess.pgn.read_game(open(path)), None)
@@ -81,9 +111,8 @@ def work_spark(args):
     with pyspark.SparkContext("local[*]", "PySparkWordCount", conf=conf) as sc:
         (sc.parallelize(args.files)
                 .flatMap(get_games)
-                .flatMap(lambda game: game.mainline())
+                .flatMap(process_game)
                 #.sample(False, .1)
-                .map(process)
                 .mapPartitions(merge)
                 .saveAsPickleFile('pikle.out')
                 )
@@ -93,8 +122,7 @@ def work_streams(args):
             .peek(print) \
             .flatmap(get_games) \
             .peek(lambda _: print('g')) \
-            .flatmap(lambda game: game.mainline()) \
-            .map(process) \
+            .flatmap(process_game) \
             .foreach(print)
             #.sample(.1) \
 
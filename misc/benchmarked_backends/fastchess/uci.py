@@ -105,6 +105,17 @@ class UCI:
             # usedful for sovling chess puzzles etc.
             'CheckPolicyTreshold': Type_Spin(default=-10000, min=-10000, max=10000),
 
+            # Positions whose evaluation and priors are shared between searches.
+            # 0 disables the transposition table.
+            'TTEntries': Type_Spin(default=100000, min=0, max=10000000),
+
+            # Processes searching each move, each with its own tree. The visits
+            # of the root moves are added up to pick the move.
+            'Threads': Type_Spin(default=1, min=1, max=128),
+
+            # Leaves evaluated together, with virtual loss on the way to them.
+            'BatchSize': Type_Spin(default=1, min=1, max=256),
+
             # TODO: Leela has many interesting options that we may consider, like
             # fpu-value (We use -.99), fpu-at-root (they use 1), policy-softmax-temp
             # (somebody said 2.2 is a good value)
@@ -230,13 +241,17 @@ class UCI:
             else:
                 self.fastchess_model = fastchess.Model(self.options['ModelPath'])
 
+        tt_entries = self.options['TTEntries']
         self.controller = MCTS_Controller(args=mcts.Args(
             model=self.fastchess_model,
             debug=self.debug,
             cpuct=self.options['MilliCPUCT'] / 1000,
             legal_t=self.options['LegalPolicyTreshold'] / 100,
             cap_t=self.options['CapturePolicyTreshold'] / 100,
-            chk_t=self.options['CheckPolicyTreshold'] / 100
+            chk_t=self.options['CheckPolicyTreshold'] / 100,
+            tt=mcts.TranspositionTable(tt_entries) if tt_entries else None,
+            threads=self.options['Threads'],
+            batch=self.options['BatchSize']
         ))
 
     def position(self, board, moves):
@@ -0,0 +1,22 @@
+from chesscompress import budget
+import chess
+
+def test_search_limit():
+    policy = budget.Budget(depth=5, limit=0.1, shallow_depth=1, shallow_limit=0.01, game_plies=2)
+    policy.new_game()
+
+    assert policy.search_limit(chess.Board("7k/8/5K2/8/8/8/8/6R1 b - - 0 1")) is None # Kh7 is forced
+    assert policy.search_limit(chess.Board("7k/6Q1/5K2/8/8/8/8/8 b - - 0 1")) is None # checkmate
+    assert policy.search_limit(chess.Board("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1")).depth == 1 # Ra8#
+    assert policy.search_limit(chess.Board()).depth == 5
+    assert policy.search_limit(chess.Board()).depth == 5
+
+    policy.record(2) # time doesn't count against the budget
+    assert policy.search_limit(chess.Board()).depth == 1 # out of full searches for this game
+    policy.new_game()
+    assert policy.search_limit(chess.Board()).depth == 5
+
+    report = policy.report()
+    assert (report["skipped"], report["shallow"], report["full"], report["over_budget"]) == (2, 1, 3, 1)
+    assert report["positions"] == 7
+    assert report["positions_per_second"] == 3.5
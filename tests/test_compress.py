@@ -0,0 +1,76 @@
+from chesscompress import compress
+import pytest
+import chess
+import chess.pgn
+import io
+
+class FirstMove:
+    """
+    Deterministic stand-in for an Evaluator, favours the first legal move
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def predict(self, fen):
+        legal_moves = list(chess.Board(fen).legal_moves)
+        return dict([(move, 0.9 if count == 0 else 0.1/len(legal_moves)) for count, move in enumerate(legal_moves)])
+
+def scholars_mate():
+    game = chess.pgn.Game()
+    node = game
+    for san in ["e4", "e5", "Qh5", "Nc6", "Bc4", "Nf6", "Qxf7#"]:
+        node = node.add_variation(node.board().parse_san(san))
+    return game
+
+def test_coder_roundtrip():
+    symbols = [0, 3, 1, 2, 2, 0, 3, 3, 1]
+    cumulative = [0, 1, 50, 60, 1000]
+
+    encoder = compress.ArithmeticEncoder()
+    for symbol in symbols:
+        encoder.encode(cumulative, symbol)
+    data = encoder.finish()
+
+    decoder = compress.ArithmeticDecoder(data)
+    assert [decoder.decode(cumulative) for _ in symbols] == symbols
+
+def test_game_roundtrip():
+    compressor = compress.Compress(Evaluator=FirstMove)
+    game = scholars_mate()
+
+    with FirstMove() as evaluator:
+        data = compressor.encode_game(evaluator, game)
+        decoded = compressor.decode_game(evaluator, data)
+
+    assert list(decoded.mainline_moves()) == list(game.mainline_moves())
+
+def test_stream_roundtrip():
+    compressor = compress.Compress(Evaluator=FirstMove)
+    games = [scholars_mate(), chess.pgn.Game(), scholars_mate()]
+    compressor.get_game = lambda n: iter(games)
+
+    out = io.BytesIO()
+    written = compressor.compress(out, n=len(games))
+    assert written == len(out.getvalue())
+
+    out.seek(0)
+    decoded = list(compressor.decompress(out))
+    assert [list(x.mainline_moves()) for x in decoded] == [list(x.mainline_moves()) for x in games]
+
+class LastMove(FirstMove):
+    """
+    Predicts differently from FirstMove, like an engine whose scores changed between encoding and decoding
+    """
+    def predict(self, fen):
+        legal_moves = list(chess.Board(fen).legal_moves)
+        return dict([(move, 0.9 if count == len(legal_moves) - 1 else 0.1/len(legal_moves)) for count, move in enumerate(legal_moves)])
+
+def test_check_value():
+    compressor = compress.Compress(Evaluator=FirstMove)
+    data = compressor.encode_game(FirstMove(), scholars_mate())
+
+    with pytest.raises(ValueError):
+        compressor.decode_game(LastMove(), data)
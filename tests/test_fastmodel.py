@@ -0,0 +1,170 @@
+from chesscompress import compress, fastmodel
+import chess
+import chess.pgn
+import io
+import sys
+import types
+import numpy as np
+import pytest
+
+class StubFastText:
+    """
+    Random fastText model with a word for every piece on every square, the castling words and every move as a label
+    """
+    def __init__(self):
+        rng = np.random.default_rng(0)
+        self.words = ["</s>"] + [square + piece for square in chess.SQUARE_NAMES for piece in "PNBRQKpnbrqk"] + ["A1-C", "H1-C", "A8-C", "H8-C"]
+        labels = set()
+        for from_square in chess.SQUARES:
+            for to_square in chess.SQUARES:
+                if from_square != to_square:
+                    labels.add(chess.Move(from_square, to_square).uci())
+                    if chess.square_rank(to_square) == 7:
+                        labels.update(chess.Move(from_square, to_square, promotion).uci() for promotion in (chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN))
+        self.labels = ["__label__" + label for label in sorted(labels)]
+        self.input_matrix = rng.normal(size=(len(self.words), 4))
+        self.output_matrix = rng.normal(size=(len(self.labels), 4))
+
+    def get_input_matrix(self):
+        return self.input_matrix
+
+    def get_output_matrix(self):
+        return self.output_matrix
+
+@pytest.fixture
+def evaluator(monkeypatch):
+    monkeypatch.setitem(sys.modules, "fasttext", types.SimpleNamespace(load_model=lambda path: StubFastText()))
+    with fastmodel.FastChess() as evaluator:
+        yield evaluator
+
+def opera_game():
+    return chess.pgn.read_game(io.StringIO("1. e4 e5 2. Nf3 d6 3. d4 Bg4 4. dxe5 Bxf3 5. Qxf3 dxe5 6. Bc4 Nf6 7. Qb3 Qe7 8. Nc3 c6 9. Bg5 b5 10. Nxb5 cxb5 11. Bxb5+ Nbd7 12. O-O-O Rd8 13. Rxd7 Rxd7 14. Rd1 Qe6 15. Bxd7+ Nxd7 16. Qb8+ Nxb8 17. Rd8#"))
+
+def test_board_vec(evaluator):
+    board = chess.Board()
+    for each_move in opera_game().mainline_moves():
+        evaluator.predict_board(board)
+        assert np.allclose(evaluator.vec, evaluator.model.from_scratch(board))
+        board.push(each_move)
+
+def test_compress_roundtrip(evaluator):
+    compressor = compress.Compress(Evaluator=fastmodel.FastChess)
+    game = opera_game()
+
+    data = compressor.encode_game(evaluator, game)
+    decoded = compressor.decode_game(evaluator, data)
+
+    assert list(decoded.mainline_moves()) == list(game.mainline_moves())
+
+def pushed_priors(model, board, vec, legal_t, cap_t, chk_t):
+    """
+    The priors get_clean_moves gives, worked out by pushing every move
+    """
+    vec = vec[1 - int(board.turn)]
+    move_to_id = model.move_to_id if board.turn else model.mirror_move_to_id
+    scores = []
+    for each_move in board.legal_moves:
+        prior = max(vec[move_to_id[each_move]] / vec[sys.modules[type(model).__module__].COUNT_INDEX], legal_t)
+        if board.is_capture(each_move):
+            prior = max(prior, cap_t)
+        board.push(each_move)
+        if board.is_check():
+            prior = max(prior, chk_t)
+        board.pop()
+        scores.append(prior)
+    scores = np.exp(np.array(scores) - max(scores))
+    return scores / scores.sum()
+
+def test_clean_moves(evaluator):
+    boards = [chess.Board(fen) for fen in [
+        "r3k2r/8/8/8/8/8/8/5K2 b kq - 0 1", # O-O+ by the rook
+        "8/8/8/k1pP3R/8/8/8/4K3 w - c6 0 2", # dxc6+ uncovers the rook
+        "8/8/8/8/8/3K4/3p4/7k b - - 0 1", # d1=Q+ through the square the pawn left
+    ]]
+    board = chess.Board()
+    for each_move in opera_game().mainline_moves():
+        boards.append(board.copy())
+        board.push(each_move)
+
+    model = evaluator.model
+    for thresholds in (dict(legal_t=1, cap_t=2, chk_t=3), evaluator.thresholds):
+        for board in boards:
+            vec = model.from_scratch(board)
+            priors = [prior for prior, _ in model.get_clean_moves(board, vec, **thresholds)]
+            assert np.allclose(priors, pushed_priors(model, board, vec, **thresholds))
+
+class RecursiveNode:
+    """
+    The tree of node objects the array tree of mcts replaced, every node keeping its own board and vector
+    """
+    def __init__(self, parent_board, parent_vec, move, prior, args):
+        self.children = []
+        self.args = args
+        self.move = move
+        self.parent_board = parent_board
+        self.parent_vec = parent_vec
+        self.P = prior
+        self.Q = 1
+        self.N = 0
+        self.game_over = None
+        if move is None:
+            self.board = parent_board
+            self.vec = parent_vec
+            self.Q, self.game_over = self.eval()
+            self.N = 1
+            self.game_over = False
+
+    def eval(self):
+        v = {"1-0": 1, "0-1": -1, "1/2-1/2": 0, "*": None}[self.board.result()]
+        if v is not None:
+            return (v if self.board.turn == chess.WHITE else -v), True
+        if self.board.is_repetition(count=2):
+            return 0, True
+        return self.args.model.get_eval(self.vec, self.board), False
+
+    def rollout(self):
+        self.N += 1
+        if self.game_over:
+            return self.Q
+        if self.N == 1:
+            self.vec = self.args.model.apply(self.parent_vec.copy(), self.parent_board, self.move)
+            self.board = self.parent_board.copy(stack=3)
+            self.board.push(self.move)
+            self.Q, self.game_over = self.eval()
+            return self.Q
+        if self.N == 2:
+            for p, move in self.args.model.get_clean_moves(self.board, self.vec, legal_t=self.args.legal_t, cap_t=self.args.cap_t, chk_t=self.args.chk_t):
+                self.children.append(RecursiveNode(self.board, self.vec, move, p, self.args))
+        sqrtN = self.args.cpuct * np.sqrt(self.N)
+        node = max(self.children, key=lambda n: -n.Q + n.P * sqrtN / (1 + n.N))
+        s = -node.rollout()
+        self.Q = ((self.N - 1) * self.Q + s) / self.N
+        return s
+
+def test_mcts_tree(evaluator):
+    import mcts # on the path once fastmodel is imported
+
+    def assert_same(node, tree_node):
+        assert [(n.move, n.N) for n in node.children] == [(n.move, n.N) for n in tree_node.children]
+        assert np.allclose([n.Q for n in node.children], [n.Q for n in tree_node.children])
+
+    args = mcts.Args(model=evaluator.model, debug=False, cpuct=4.3, **evaluator.thresholds)
+    for fen in (chess.STARTING_FEN, "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3", "6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1"):
+        board = chess.Board(fen)
+        vec = evaluator.model.from_scratch(board)
+        node = RecursiveNode(board, vec, None, 0, args)
+        tree_node = mcts.Tree(board, vec, args, capacity=16, vec_visits=3).root
+        for _ in range(500):
+            node.rollout()
+            tree_node.rollout()
+        assert_same(node, tree_node)
+
+        # Searching on from the most visited child, after it's played
+        node = max(node.children, key=lambda n: n.N)
+        tree_node = max(tree_node.children, key=lambda n: n.N)
+        tree_node = tree_node.tree.reroot(tree_node.index)
+        assert tree_node.board == node.board
+        for _ in range(200):
+            node.rollout()
+            tree_node.rollout()
+        assert_same(node, tree_node)
@@ -0,0 +1,37 @@
+from chesscompress import compress, heuristic
+import chess
+import chess.pgn
+import io
+
+def test_predict():
+    with heuristic.Heuristic() as evaluator:
+        probabilities = evaluator.predict("6k1/8/8/8/8/8/3q4/3RK3 w - - 0 1")
+
+    assert set(probabilities) == set(chess.Board("6k1/8/8/8/8/8/3q4/3RK3 w - - 0 1").legal_moves)
+    assert abs(sum(probabilities.values()) - 1) < 1e-9
+    assert next(iter(probabilities)).to_square == chess.D2 # taking the queen
+
+def test_promotion_check():
+    board = chess.Board("8/8/8/8/8/3K4/3p4/7k b - - 0 1") # the pawn blocks d1=Q+ until it promotes
+    promotion = chess.Move.from_uci("d2d1q")
+    scores = [evaluator.score(board, promotion, None, None, evaluator.check_squares(board)) for evaluator in (heuristic.Heuristic(), heuristic.Heuristic(check=0))]
+    assert scores[0] - scores[1] == 60
+
+def test_analyze_game():
+    game = chess.pgn.read_game(io.StringIO("1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Bxc6 dxc6 *"))
+    with heuristic.Heuristic() as evaluator:
+        results = evaluator.analyze_game(game)
+
+    assert len(results) == 8
+    legal_moves, move_results = results[-1]
+    assert max(zip(move_results, legal_moves))[1] in (chess.Move.from_uci("d7c6"), chess.Move.from_uci("b7c6")) # a recapture
+
+def test_compress_roundtrip():
+    compressor = compress.Compress(Evaluator=heuristic.Heuristic)
+    game = chess.pgn.read_game(io.StringIO("1. d4 Nf6 2. c4 e6 3. Nc3 Bb4 4. Qc2 O-O 5. a3 Bxc3+ 6. Qxc3 *"))
+
+    with heuristic.Heuristic() as evaluator:
+        data = compressor.encode_game(evaluator, game)
+        decoded = compressor.decode_game(evaluator, data)
+
+    assert list(decoded.mainline_moves()) == list(game.mainline_moves())
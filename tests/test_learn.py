@@ -0,0 +1,68 @@
+from chesscompress import learn, uci, budget, store
+import chess.pgn
+import io
+import ast
+import numpy as np
+
+unrated = """[Event "Rated Blitz game"]
+[Result "1-0"]
+
+1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0
+"""
+
+rated = """[Event "Rated Blitz game"]
+[Result "1-0"]
+[WhiteElo "1500"]
+[BlackElo "1700"]
+
+1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0
+"""
+
+def test_filters_keep_defaults(tmp_path):
+    learner = learn.Learn(cache_loc=str(tmp_path), filters={"min_plies": 1})
+
+    assert not learner.accept_game(unrated) # game_metadata needs both ratings
+    assert learner.accept_game(rated)
+    assert not learn.Learn(cache_loc=str(tmp_path), filters={"min_plies": 8}).accept_game(rated)
+    assert not learn.Learn(cache_loc=str(tmp_path), filters={"min_elo": 1700}).accept_game(rated)
+
+def test_evaluator_kwargs(tmp_path):
+    learner = learn.Learn(cache_loc=str(tmp_path), engine_options={"Hash": 64}, book_loc="cache/book.sqlite3")
+    assert learner.evaluator_kwargs() == {"options": {"Hash": 64}, "book_loc": "cache/book.sqlite3"}
+    assert learn.Learn(cache_loc=str(tmp_path)).evaluator_kwargs() == {}
+
+class Searched(uci.Uci):
+    """
+    Uci without an engine, its analysis records the depth each position was searched to
+    """
+    def __init__(self, **kwargs):
+        self.setup("stockfish", 5, 0.1, None, True, None, budget.Budget(game_plies=1))
+
+    def __exit__(self, *args):
+        pass
+
+    def analyze_board(self, board, limit, game=None):
+        return list(board.legal_moves), [limit.depth]*len(list(board.legal_moves))
+
+def test_build_book(tmp_path):
+    learner = learn.Learn(Evaluator=Searched, cache_loc=str(tmp_path))
+    games = [chess.pgn.read_game(io.StringIO(rated)) for _ in range(3)]
+    learner.get_game = lambda n: iter(games)
+
+    book_loc = learner.build_book(n=len(games), plies=7)
+    with store.Store(book_loc, readonly=True) as book:
+        entries = dict(book.items())
+
+    # each position is keyed by the depth it was searched to, and the budget restarts for each of them
+    depths = [ast.literal_eval(key)[1] for key in entries]
+    assert depths == [move_results[0] for _, move_results in entries.values()]
+    assert sorted(depths) == [1] + [5]*6 # Qxf7# is a mate in one, a shallow search
+
+def test_generate(tmp_path):
+    with open(tmp_path / "lichess_db_standard_rated_2018-01.pgn", "w") as f:
+        f.write("\n".join(rated.replace("[Result", '[Site "https://lichess.org/%d"]\n[Result' % number) for number in range(5)))
+    learner = learn.Learn(loc=str(tmp_path) + "/", Evaluator=Searched, cache_loc=str(tmp_path), dataset_loc=str(tmp_path / "dataset"), engines=2, parsers=2)
+
+    shards = learner.generate(n=5, shard_size=1 << 10)
+    assert len(shards) == 1
+    assert np.load(shards[0][1]).shape == (5*7,) # every ply of every game, analyzed by the engine threads
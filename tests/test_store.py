@@ -0,0 +1,23 @@
+from chesscompress import store
+import pickle
+
+def test_put_get(tmp_path):
+    with store.Store(str(tmp_path / "cache.sqlite3"), batch=2) as cache:
+        assert cache.get((1, 5, 0.1)) is False
+        cache.put((1, 5, 0.1), ([1, 2], [0.5, 0.5]))
+        assert cache.get((1, 5, 0.1)) == ([1, 2], [0.5, 0.5]) # served from the pending batch
+
+    with store.Store(str(tmp_path / "cache.sqlite3"), readonly=True) as cache:
+        assert cache.get((1, 5, 0.1)) == ([1, 2], [0.5, 0.5])
+        cache.put((2, 5, 0.1), "ignored")
+        assert cache.get((2, 5, 0.1)) is False
+
+def test_pickle_reconnects(tmp_path):
+    cache = store.Store(str(tmp_path / "cache.sqlite3"))
+    cache.put("a", 1)
+    cache.flush()
+
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.get("a") == 1
+    copy.close()
+    cache.close()
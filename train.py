@@ -1,33 +1,70 @@
 from tensorflow import keras
 import numpy as np
 import tensorflow as tf
-import pickle
+import glob
+import math
 
 # filename = "dataset-no-flip"
 filename = "dataset"
-with open("models/" + filename + ".pickle", "rb") as f:
-    dataset = list(pickle.load(f))
 
-size = 100
+# Shards written by Learn.generate, streamed so they never have to fit in RAM
+feature_files = sorted(glob.glob("models/" + filename + "/features-*.npy"))
+label_files = sorted(glob.glob("models/" + filename + "/labels-*.npy"))
+assert feature_files and len(feature_files) == len(label_files)
 
-def input_dataset():
-    for each_game in list(dataset):
-        for each_move in each_game:
-            # print(each_move)
-            data = ([each_move[1][2]/3500]) # roughly normalized avg rating
-            move_evals = each_move[1][0]
+width = np.load(feature_files[0], mmap_mode="r").shape[1]
+size = width # rows are padded or truncated to this on the fly
+batch_size = 64
+chunk_size = 4096 # rows read from a memory-mapped shard at a time
+shuffle_buffer = 1 << 16
+validation_split = 0.2
 
-            data.extend(move_evals)
+def read_shard(features_file, labels_file):
+    features = np.load(features_file.decode(), mmap_mode="r")
+    labels = np.load(labels_file.decode(), mmap_mode="r")
+    for start in range(0, len(labels), chunk_size):
+        yield np.asarray(features[start:start + chunk_size]), np.asarray(labels[start:start + chunk_size])
 
-            data.extend([0]*(size-len(data)))
-            # print(len(move_evals))
-            assert len(data) == size
-            yield data
+def shard_dataset(features_file, labels_file):
+    return tf.data.Dataset.from_generator(read_shard,
+                                          output_types=(tf.float32, tf.int64),
+                                          output_shapes=((None, width), (None,)),
+                                          args=(features_file, labels_file)).unbatch()
 
-def gen_label():
-    for each_game in list(dataset):
-        for each_move in each_game:
-            yield (each_move[0])
+def pad(features, labels):
+    features = features[:, :size]
+    features = tf.pad(features, [[0, 0], [0, size - tf.shape(features)[1]]])
+    return features, labels
+
+def input_dataset(features_files, labels_files, shuffle=True, skip=0, take=-1):
+    """ skip and take select rows, to split a single shard """
+    files = tf.data.Dataset.from_tensor_slices((features_files, labels_files))
+    if shuffle:
+        files = files.shuffle(len(features_files))
+
+    dataset = files.interleave(shard_dataset,
+                               cycle_length=min(4, len(features_files)),
+                               num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.skip(skip).take(take)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer)
+
+    return dataset.batch(batch_size) \
+                  .map(pad, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+                  .prefetch(tf.data.experimental.AUTOTUNE)
+
+# like validation_split, the last shards are held out
+if len(feature_files) > 1:
+    held_out = math.ceil(len(feature_files) * validation_split)
+    split = len(feature_files) - held_out
+    train_data = input_dataset(feature_files[:split], label_files[:split])
+    validation_data = input_dataset(feature_files[split:], label_files[split:], shuffle=False)
+else:
+    # or with a single shard, its last rows
+    rows = len(np.load(label_files[0], mmap_mode="r"))
+    split = rows - math.ceil(rows * validation_split)
+    train_data = input_dataset(feature_files, label_files, take=split)
+    validation_data = input_dataset(feature_files, label_files, shuffle=False, skip=split)
 
 # print(list(input_dataset()))
 model = keras.Sequential([
@@ -47,13 +84,9 @@ model.compile(optimizer='adam',
               loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
               metrics=['accuracy'])
 
-input_data = np.array(list(input_dataset()))
-labels = np.array(list(gen_label()))
-model.fit(input_data, 
-          labels, 
-          epochs=50, 
-          validation_split=0.2,
-          batch_size=64)
+model.fit(train_data,
+          validation_data=validation_data,
+          epochs=50)
 
 model.summary()
 model.save("models/" + filename + ".h5")